@@ -0,0 +1,154 @@
+"""
+Microbenchmark of the audio DSP functions of utils/audio_process.py and their
+torch counterparts in utils/torch_audio.py, on synthetic signals.
+
+Times every function over a range of utterance lengths (and Griffin-Lim
+iteration counts for the inverse ones), and writes one JSON line per case with
+audio-seconds processed per wall-second and peak memory.
+
+Peak memory is what tracemalloc sees, i.e. numpy and Python allocations of the
+call. tracemalloc does not see the torch CPU allocator, so torch functions
+report torch.cuda.max_memory_allocated on CUDA, and null on CPU.
+
+Usage:
+    python -m benchmarks.audio_dsp
+    python -m benchmarks.audio_dsp --functions spectrogram,inv_spectrogram --seconds 1,10 --iters 30,60
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+from scipy.io import wavfile
+
+import hyperparams as hparams
+from utils import audio_process, torch_audio
+
+FUNCTIONS = ['load_wav', 'stft', 'istft', 'spectrogram', 'melspectrogram', 'griffin_lim',
+             'inv_spectrogram', 'torch_spectrogram', 'torch_inv_spectrogram']
+# functions running hparams.griffin_lim_iters (torch_griffin_lim_iters for torch ones) iterations
+ITERATIVE = {'griffin_lim', 'inv_spectrogram', 'torch_inv_spectrogram'}
+
+parser = argparse.ArgumentParser("Audio DSP benchmark")
+parser.add_argument('--functions', default=','.join(FUNCTIONS), type=str,
+                    help='Comma separated functions to time: ' + ', '.join(FUNCTIONS))
+parser.add_argument('--seconds', default='1,4,10', type=str, help='Comma separated utterance lengths in seconds')
+parser.add_argument('--iters', default='30,60', type=str,
+                    help='Comma separated Griffin-Lim iterations, for ' + ', '.join(sorted(ITERATIVE)))
+parser.add_argument('--repeat', default=3, type=int, help='Timed calls per case, after one warm up call')
+parser.add_argument('--device', default='cpu', type=str, help='Device of the torch functions')
+parser.add_argument('--output', default='', type=str, help='JSON lines output file, default is stdout')
+
+
+def make_signal(seconds, sample_rate, seed=0):
+    """Noisy chirp, [T] float32"""
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    wav = 0.5 * np.sin(2 * np.pi * 200 * (1 + t) * t) + 0.01 * rng.randn(len(t))
+    return wav.astype(np.float32)
+
+
+def build_case(function, seconds, tmp_dir, device):
+    """Returns a callable running function on an utterance of seconds"""
+    wav = make_signal(seconds, hparams.sample_rate)
+    if function == 'load_wav':
+        path = os.path.join(tmp_dir, '{}.wav'.format(seconds))
+        wavfile.write(path, hparams.sample_rate, (wav * 32767).astype(np.int16))
+        return lambda: audio_process.load_wav(path, hparams.sample_rate)
+    if function == 'stft':
+        return lambda: audio_process._stft(wav)
+    if function == 'istft':
+        D = audio_process._stft(wav)
+        return lambda: audio_process._istft(D)
+    if function == 'spectrogram':
+        return lambda: audio_process.spectrogram(wav)
+    if function == 'melspectrogram':
+        return lambda: audio_process.melspectrogram(wav)
+    if function == 'griffin_lim':
+        S = np.abs(audio_process._stft(wav))
+        return lambda: audio_process._griffin_lim(S)
+    if function == 'inv_spectrogram':
+        spec = audio_process.spectrogram(wav)
+        return lambda: audio_process.inv_spectrogram(spec)
+    wavs = torch.from_numpy(wav).unsqueeze(0).to(device)
+    lengths = torch.LongTensor([len(wav)]).to(device)
+    if function == 'torch_spectrogram':
+        return lambda: _sync(torch_audio.spectrogram(wavs, lengths))
+    if function == 'torch_inv_spectrogram':
+        spec, frame_lengths = torch_audio.spectrogram(wavs, lengths)
+        return lambda: _sync(torch_audio.inv_spectrogram(spec, frame_lengths))
+    raise ValueError("function should be one of {}, but got "
+                     "function={}".format(FUNCTIONS, function))
+
+
+def _sync(outputs):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return outputs
+
+
+def measure(fn, repeat, device=None):
+    """Returns (mean seconds per call, peak memory in bytes)
+    Args:
+        device: device of a torch function, None for numpy ones
+    Returns:
+        peak is None for torch functions on CPU, see the module docstring
+    """
+    fn()  # warm up lazy imports, filterbank and FFT plan caches
+    use_cuda = str(device).startswith('cuda')
+    if use_cuda:
+        torch.cuda.reset_peak_memory_stats(device)
+    traced = device is None
+    if traced:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if traced else None
+    finally:
+        if traced:
+            tracemalloc.stop()
+    if use_cuda:
+        peak = torch.cuda.max_memory_allocated(device)
+    return wall / repeat, peak
+
+
+def main(args):
+    functions = args.functions.split(',')
+    iters_list = [int(x) for x in args.iters.split(',')]
+    default_iters = hparams.griffin_lim_iters, hparams.torch_griffin_lim_iters
+    tmp_dir = tempfile.TemporaryDirectory()
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for function in functions:
+            for seconds in map(float, args.seconds.split(',')):
+                fn = build_case(function, seconds, tmp_dir.name, args.device)
+                for iters in (iters_list if function in ITERATIVE else [None]):
+                    if iters is not None:
+                        hparams.griffin_lim_iters = hparams.torch_griffin_lim_iters = iters
+                    device = args.device if function.startswith('torch_') else None
+                    wall, peak = measure(fn, args.repeat, device)
+                    result = {'benchmark': 'audio_dsp', 'function': function, 'seconds': seconds,
+                              'griffin_lim_iters': iters, 'repeat': args.repeat,
+                              'wall_seconds': wall,
+                              'audio_seconds_per_sec': seconds / wall,
+                              'peak_memory_mb': peak / 2 ** 20 if peak is not None else None}
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+    finally:
+        hparams.griffin_lim_iters, hparams.torch_griffin_lim_iters = default_iters
+        if output is not sys.stdout:
+            output.close()
+        tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
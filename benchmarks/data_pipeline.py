@@ -0,0 +1,174 @@
+"""
+Throughput of the training input pipeline:
+LJSpeechDataset + RandomBucketBatchSampler + collate_fn through a DataLoader.
+
+Sweeps num_workers, batch size and feature source, and writes one JSON line
+per configuration with items/sec, batches/sec, audio-seconds/sec and worker
+utilization (time spent in __getitem__ + collate_fn over wall time x workers).
+
+Feature sources:
+- wav: load_wav + spectrogram in DataLoader workers
+- device: load_wav in workers, batched torch spectrogram in the main process
+- store: memory-mapped features written by preprocess.py
+
+Usage:
+    python -m benchmarks.data_pipeline --num_utterances 200 --output pipeline.jsonl
+    python -m benchmarks.data_pipeline --train_dir data/LJSpeech-1.1 --train_csv data/LJSpeech-1.1/metadata.csv
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+from scipy.io import wavfile
+from torch.utils.data import DataLoader
+
+import hyperparams as hparams
+from utils.audio_process import get_hop_size, spectrogram
+from utils.data import LJSpeechDataset, RandomBucketBatchSampler, TextAudioCollate, TextWavCollate
+from utils.feature_store import FeatureStore, write_feature_store
+from utils.text_process import text_to_sequence
+from utils.torch_audio import BatchFeatureExtractor
+
+parser = argparse.ArgumentParser("Data pipeline benchmark")
+parser.add_argument('--train_dir', type=str, default='', help='dir including wav, default is a synthetic corpus')
+parser.add_argument('--train_csv', type=str, default='', help='csv file such metadata.csv')
+parser.add_argument('--num_utterances', default=200, type=int, help='Size of the synthetic corpus')
+parser.add_argument('--min_seconds', default=1.0, type=float, help='Min duration of synthetic utterances')
+parser.add_argument('--max_seconds', default=8.0, type=float, help='Max duration of synthetic utterances')
+parser.add_argument('--num_workers', default='0,1,2,4', type=str, help='Comma separated num_workers to sweep')
+parser.add_argument('--batch_size', default='8,16,32', type=str, help='Comma separated batch sizes to sweep')
+parser.add_argument('--sources', default='wav,device,store', type=str,
+                    help='Comma separated feature sources to sweep: wav, device, store')
+parser.add_argument('--max_batches', default=0, type=int, help='Batches per run, 0 means one epoch')
+parser.add_argument('--output', default='', type=str, help='JSON lines output file, default is stdout')
+
+
+def make_synthetic_corpus(root, num_utterances, min_seconds, max_seconds, seed=0):
+    """Write an LJSpeech style corpus of noisy chirps, returns path of metadata.csv"""
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(root, 'wavs'), exist_ok=True)
+    csv_file = os.path.join(root, 'metadata.csv')
+    with open(csv_file, 'w') as f:
+        for i in range(num_utterances):
+            seconds = rng.uniform(min_seconds, max_seconds)
+            t = np.arange(int(seconds * hparams.sample_rate)) / hparams.sample_rate
+            freq = rng.uniform(100, 400) * (1 + t)
+            wav = 0.5 * np.sin(2 * np.pi * freq * t) + 0.01 * rng.randn(len(t))
+            wavfile.write(os.path.join(root, 'wavs', 'S%05d.wav' % i), hparams.sample_rate,
+                          (wav * 32767).astype(np.int16))
+            text = ' '.join('abcdefgh'[:rng.randint(2, 8)] for _ in range(int(seconds * 3)))
+            f.write('S%05d|%s|%s\n' % (i, text, text))
+    return csv_file
+
+
+class _TimedDataset(torch.utils.data.Dataset):
+    """Returns (item, seconds spent in __getitem__)"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        item = self.dataset[index]
+        return item, time.perf_counter() - start
+
+
+class _TimedCollate(object):
+    """Returns (batch, seconds spent in __getitem__ and collate_fn)"""
+
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        start = time.perf_counter()
+        busy = sum(seconds for _, seconds in batch)
+        batch = self.collate_fn([item for item, _ in batch])
+        return batch, busy + time.perf_counter() - start
+
+
+def run(dataset, collate_fn, batch_size, num_workers, max_batches, batch_transform=None):
+    collate_fn([dataset[0]])  # warm up lazy imports and caches, e.g. librosa
+    batch_sampler = RandomBucketBatchSampler(dataset, batch_size=batch_size, drop_last=False)
+    data_loader = DataLoader(_TimedDataset(dataset), batch_sampler=batch_sampler,
+                             collate_fn=_TimedCollate(collate_fn), num_workers=num_workers)
+    items, batches, frames, busy = 0, 0, 0, 0.0
+    start = time.perf_counter()
+    for batch, seconds in data_loader:
+        if batch_transform is not None:
+            transform_start = time.perf_counter()
+            batch = batch_transform(*batch)
+            seconds += time.perf_counter() - transform_start
+        decoder_mask = batch[-1]
+        items += decoder_mask.size(0)
+        frames += int((~decoder_mask).sum())
+        batches += 1
+        busy += seconds
+        if batches == max_batches:
+            break
+    wall = time.perf_counter() - start
+    audio_seconds = frames * get_hop_size() / hparams.sample_rate
+    return {
+        'items_per_sec': items / wall,
+        'batches_per_sec': batches / wall,
+        'audio_seconds_per_sec': audio_seconds / wall,
+        # the main process does the work when num_workers is 0
+        'worker_utilization': busy / (wall * max(num_workers, 1)),
+        'items': items, 'batches': batches, 'wall_seconds': wall,
+    }
+
+
+def main(args):
+    tmp_dir = tempfile.TemporaryDirectory()
+    train_dir, csv_file = args.train_dir, args.train_csv
+    if not train_dir:
+        train_dir = os.path.join(tmp_dir.name, 'corpus')
+        csv_file = make_synthetic_corpus(train_dir, args.num_utterances, args.min_seconds, args.max_seconds)
+    index_file = os.path.join(tmp_dir.name, 'duration_index.npz')
+    sources = args.sources.split(',')
+
+    datasets = {}
+    if 'wav' in sources:
+        datasets['wav'] = LJSpeechDataset(train_dir, csv_file, text_transformer=text_to_sequence,
+                                          audio_transformer=spectrogram, index_file=index_file)
+    if 'device' in sources:
+        datasets['device'] = LJSpeechDataset(train_dir, csv_file, text_transformer=text_to_sequence,
+                                             index_file=index_file)
+    if 'store' in sources:
+        store_dir = os.path.join(tmp_dir.name, 'store')
+        dataset = LJSpeechDataset(train_dir, csv_file, sort=False)
+        write_feature_store(store_dir, train_dir, dataset.get_wav_ids(), spectrogram,
+                            sample_rate=hparams.sample_rate, num_workers=os.cpu_count())
+        datasets['store'] = LJSpeechDataset(train_dir, csv_file, text_transformer=text_to_sequence,
+                                            feature_store=FeatureStore(store_dir))
+
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for source in sources:
+            collate_fn = TextWavCollate() if source == 'device' else TextAudioCollate()
+            batch_transform = BatchFeatureExtractor() if source == 'device' else None
+            for num_workers in map(int, args.num_workers.split(',')):
+                for batch_size in map(int, args.batch_size.split(',')):
+                    result = run(datasets[source], collate_fn, batch_size, num_workers,
+                                 args.max_batches, batch_transform)
+                    result.update({'benchmark': 'data_pipeline', 'source': source,
+                                   'num_workers': num_workers, 'batch_size': batch_size,
+                                   'num_utterances': len(datasets[source])})
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        tmp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
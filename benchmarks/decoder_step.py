@@ -0,0 +1,89 @@
+"""
+Microbenchmark of one Decoder step, with and without Decoder.fuse_attention.
+
+Runs decoder steps on random encoder outputs, for a range of batch sizes and
+encoder lengths, and writes one JSON line per case with the mean wall time
+per step. Weights are random, or loaded from a training checkpoint.
+
+Usage:
+    python -m benchmarks.decoder_step
+    python -m benchmarks.decoder_step --model_path exp/temp/final.pth.tar --batch_sizes 1 --threads 1,4
+"""
+import argparse
+import json
+import sys
+import time
+
+import torch
+
+import hyperparams as hparams
+from src.model import FeaturePredictNet
+
+parser = argparse.ArgumentParser("Decoder step benchmark")
+parser.add_argument('--model_path', default='', type=str, help='Checkpoint saved by training, default is random weights')
+parser.add_argument('--batch_sizes', default='1,8', type=str, help='Comma separated batch sizes')
+parser.add_argument('--input_lengths', default='50,200', type=str, help='Comma separated encoder lengths')
+parser.add_argument('--threads', default='1', type=str, help='Comma separated torch CPU threads')
+parser.add_argument('--steps', default=200, type=int, help='Timed steps per case, after warm up steps')
+parser.add_argument('--repeat', default=5, type=int, help='Timed runs per case, the fastest is reported')
+parser.add_argument('--device', default='cpu', type=str, help='Device of the model')
+parser.add_argument('--output', default='', type=str, help='JSON lines output file, default is stdout')
+
+
+def _sync(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize(device)
+
+
+def measure(decoder, batch_size, input_length, steps, repeat, device):
+    """Returns {fuse_attention: seconds per decoder step}, the fastest of repeat runs.
+    Runs with and without fusion alternate, so both see the same machine load.
+    """
+    encoder_padded_outputs = torch.randn(batch_size, input_length, decoder.encoder_hidden_size, device=device)
+    step_input = torch.randn(batch_size, decoder.prenet.linear2.out_features, device=device)
+    best = {False: float('inf'), True: float('inf')}
+    with torch.no_grad():
+        for _ in range(repeat):
+            for fuse_attention in (False, True):
+                decoder.fuse_attention = fuse_attention
+                decoder._init_state(encoder_padded_outputs)
+                decoder.encoder_mask = None
+                decoder.attention.reset()
+                for _ in range(10):  # warm up, and the per-utterance V*h cache
+                    decoder._step(step_input)
+                _sync(device)
+                start = time.perf_counter()
+                for _ in range(steps):
+                    decoder._step(step_input)
+                _sync(device)
+                best[fuse_attention] = min(best[fuse_attention], (time.perf_counter() - start) / steps)
+    return best
+
+
+def main(args):
+    if args.model_path:
+        model = FeaturePredictNet.load_model(args.model_path)
+    else:
+        model = FeaturePredictNet(hparams.num_chars, hparams.padding_idx, hparams.feature_dim)
+    decoder = model.decoder.to(args.device).eval()
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for threads in map(int, args.threads.split(',')):
+            torch.set_num_threads(threads)
+            for batch_size in map(int, args.batch_sizes.split(',')):
+                for input_length in map(int, args.input_lengths.split(',')):
+                    seconds = measure(decoder, batch_size, input_length, args.steps, args.repeat, args.device)
+                    result = {'benchmark': 'decoder_step', 'device': args.device, 'threads': threads,
+                              'batch_size': batch_size, 'input_length': input_length,
+                              'step_ms': seconds[False] * 1e3, 'fused_attention_step_ms': seconds[True] * 1e3,
+                              'speedup': seconds[False] / seconds[True]}
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,43 @@
+import argparse
+import json
+
+import torch
+
+import hyperparams as hparams
+from src.model import FeaturePredictNet
+from src.quantize import compare_quantized, quantize_model
+from src.scripted import export_scripted
+from utils.text_process import text_to_sequence
+
+parser = argparse.ArgumentParser("Export FeaturePredictNet to TorchScript")
+parser.add_argument('--model_path', type=str, required=True, help='Checkpoint saved by training')
+parser.add_argument('--out_path', type=str, required=True, help='TorchScript artifact, e.g. final.ts')
+parser.add_argument('--quantize', type=int, default=0,
+                    help='Export an int8 model for CPU inference, see src/quantize.py')
+parser.add_argument('--text_file', type=str, default=None,
+                    help='With --quantize, texts to compare the int8 model against the float one')
+
+
+def main(args):
+    model = FeaturePredictNet.load_model(args.model_path)
+    model.eval()
+    if args.quantize:
+        quantized = quantize_model(model)
+        if args.text_file:
+            with open(args.text_file, 'r') as text_file:
+                texts = [torch.LongTensor(text_to_sequence(line)) for line in text_file if line.strip()]
+            input_lengths = torch.LongTensor([len(text) for text in texts])
+            text_padded = torch.full((len(texts), int(input_lengths.max())), hparams.padding_idx, dtype=torch.long)
+            for i, text in enumerate(texts):
+                text_padded[i, :len(text)] = text
+            report = compare_quantized(model, quantized, text_padded, input_lengths)
+            print('Quantized vs float: {}'.format(json.dumps(report)))
+        model = quantized
+    export_scripted(model, args.out_path)
+    print('Saved TorchScript model to {}'.format(args.out_path))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -19,13 +19,28 @@ max_abs_value = 4
 power = 1.5
 fft_size = 1024
 hop_size = 256
+# Precision of utils/audio_process.py, 'float32' (complex64 FFTs) or 'float64'
+audio_dtype = 'float32'
+# Mel filterbanks and their pseudo-inverses are cached here, None disables it
+filterbank_cache_dir = '~/.cache/tacotron2/filterbanks'
 
 # Encoder
 num_chars = len(chars) + 1  # + 1 is <unk>
 padding_idx = chars.find(pad)
 
 # Decoder
+# Target features: 'linear' spectrogram of feature_dim bins or 'mel' spectrogram of num_mels bins
+feature_type = 'linear'
 feature_dim = 1025 
+# Windowed attention (--attention_window): energies only over the encoder steps
+# [peak - backward, peak + forward] around the previous attention peak
+attention_window_backward = 8
+attention_window_forward = 24
 
 # Eval:
 griffin_lim_iters = 60
+# Momentum of fast Griffin-Lim in utils/torch_audio.py, 0 is plain Griffin-Lim.
+# With 0.99 about half of the iterations reach the quality of plain Griffin-Lim.
+griffin_lim_momentum = 0.99
+# Iterations of fast Griffin-Lim, griffin_lim_iters is for plain Griffin-Lim of audio_process
+torch_griffin_lim_iters = 30
@@ -1,12 +1,18 @@
 
 import argparse
+import os
 
 import torch
 from torch.utils.data import DataLoader
 
 import hyperparams as hparams
-from utils.audio_process import spectrogram
-from utils.data import LJSpeechDataset, RandomBucketBatchSampler, TextAudioCollate
+from utils.audio_process import FEATURE_TYPES, get_feature_dim, get_feature_extractor
+from utils.cache import DiskLRUCache
+from utils.data import (DistributedBucketBatchSampler, FrameBudgetBatchSampler, LJSpeechDataset,
+                        RandomBucketBatchSampler, TextAudioCollate, TextWavCollate)
+from utils.feature_store import FeatureStore
+from utils.shards import ShardedDataset
+from utils.torch_audio import BatchFeatureExtractor
 from src.loss import FeaturePredictNetLoss
 from src.model import FeaturePredictNet
 from utils.text_process import text_to_sequence
@@ -15,10 +21,33 @@ from utils.solver import Solver
 parser = argparse.ArgumentParser("Tacotron2 FeaturePredictNet Training")
 parser.add_argument('--train_dir', type=str, required=True, help='dir including wav')
 parser.add_argument('--train_csv', type=str, default='metadata.csv', help='csv file such metadata.csv')
+parser.add_argument('--index_file', type=str, default='',
+                    help='Duration index to sort the dataset, default is {train_dir}/duration_index.npz')
+parser.add_argument('--wav_cache_dir', type=str, default='',
+                    help='Dir to cache decoded and resampled audio, e.g. for 48 kHz corpora')
+parser.add_argument('--wav_cache_size', default=10240, type=int, help='Max size of the audio cache in MB')
+parser.add_argument('--feature_store', type=str, default='', help='Dir of features extracted by preprocess.py')
+parser.add_argument('--shards_dir', type=str, default='',
+                    help='Dir of shards packed by preprocess.py, stream them instead of reading wavs')
+parser.add_argument('--shuffle_buffer', default=1024, type=int, help='Shuffle buffer size of shards')
+parser.add_argument('--num_workers', default=1, type=int, help='Number of DataLoader workers')
+parser.add_argument('--feature_extraction', default='worker', choices=['worker', 'device'],
+                    help='worker: spectrogram in DataLoader workers, '
+                         'device: batched torch spectrogram on the training device')
+parser.add_argument('--feature_type', default=hparams.feature_type, choices=FEATURE_TYPES,
+                    help='Target features: linear spectrogram or mel spectrogram (num_mels bins)')
+parser.add_argument('--attention_window', type=int, default=0,
+                    help='Train with windowed attention, see hparams.attention_window_backward/forward')
 parser.add_argument('--use_cuda', type=int, default=1)
 parser.add_argument('--epochs', default=500, type=int)
 parser.add_argument('--max_norm', default=1, type=float, help='Gradient norm threshold to clip')
 parser.add_argument('--batch_size', default=16, type=int)
+parser.add_argument('--max_frames', default=0, type=int,
+                    help='Max padded frames per batch, use frame-budget batching instead of batch_size if > 0')
+parser.add_argument('--max_tokens', default=0, type=int,
+                    help='Max padded text tokens per batch, used if > 0 and max_frames is 0')
+parser.add_argument('--max_padding_ratio', default=0.2, type=float, help='Max padding ratio of frame-budget batch')
+parser.add_argument('--seed', default=0, type=int, help='Seed of batch shuffling')
 parser.add_argument('--lr', default=1e-3, type=float, help='Init learning rate')
 parser.add_argument('--l2', default=0.0, type=float, help='weight decay (L2)')
 parser.add_argument('--save_folder', default='exp/temp', help='Dir to save models')
@@ -29,29 +58,107 @@ parser.add_argument('--print_freq', default=1, type=int, help='Frequency of prin
 parser.add_argument('--visdom', type=int, default=0, help='Turn on visdom graphing')
 parser.add_argument('--visdom_epoch', type=int, default=0, help='Turn on visdom graphing each epoch')
 parser.add_argument('--visdom_id', default='Taco2 training', help='Identifier for visdom run')
+# distributed training, defaults are set by torchrun
+parser.add_argument('--world_size', default=int(os.environ.get('WORLD_SIZE', 1)), type=int,
+                    help='Number of training processes')
+parser.add_argument('--rank', default=int(os.environ.get('RANK', 0)), type=int, help='Rank of this process')
+parser.add_argument('--dist_backend', default='gloo', help='torch.distributed backend, gloo for CPU')
+parser.add_argument('--dist_url', default='env://', help='torch.distributed init method')
 
 
-def main(args):
+def build_data_loader(args, collate_fn, distributed):
+    feature_store = FeatureStore(args.feature_store) if args.feature_store else None
+    if feature_store is not None:
+        check_feature_store(feature_store, args)
+    index_file = args.index_file or os.path.join(args.train_dir, 'duration_index.npz')
+    wav_cache = DiskLRUCache(args.wav_cache_dir, args.wav_cache_size * 1024 * 1024) \
+        if args.wav_cache_dir else None
     dataset = LJSpeechDataset(args.train_dir, args.train_csv,
                               text_transformer=text_to_sequence,
-                              audio_transformer=spectrogram)
+                              audio_transformer=get_feature_extractor(args.feature_type)
+                              if args.feature_extraction == 'worker' else None,
+                              feature_store=feature_store,
+                              index_file=index_file,
+                              wav_cache=wav_cache)
     print(len(dataset))
-    batch_sampler = RandomBucketBatchSampler(dataset,
-                                             batch_size=args.batch_size,
-                                             drop_last=False)
-    collate_fn = TextAudioCollate()
-    data_loader = DataLoader(dataset, batch_sampler=batch_sampler,
-                            collate_fn=collate_fn, num_workers=1)
+    if args.max_frames > 0 or args.max_tokens > 0:
+        frames, text_lengths = dataset.get_lengths()
+        batch_sampler = FrameBudgetBatchSampler(frames if args.max_frames > 0 else text_lengths,
+                                                max_frames=args.max_frames or args.max_tokens,
+                                                max_padding_ratio=args.max_padding_ratio,
+                                                seed=args.seed)
+    else:
+        batch_sampler = RandomBucketBatchSampler(dataset,
+                                                 batch_size=args.batch_size,
+                                                 drop_last=False)
+    if distributed:
+        batch_sampler = DistributedBucketBatchSampler(batch_sampler, args.world_size, args.rank,
+                                                      seed=args.seed)
+    return DataLoader(dataset, batch_sampler=batch_sampler,
+                      collate_fn=collate_fn, num_workers=args.num_workers)
+
+
+def check_feature_store(feature_store, args):
+    """Raise if the features of feature_store are not of args.feature_type"""
+    feature_dim = get_feature_dim(args.feature_type)
+    if feature_store.feature_type and feature_store.feature_type != args.feature_type \
+            or feature_store.feature_dim != feature_dim:
+        raise ValueError("feature_type should match the store's {} features of {} bins, but got "
+                         "feature_type={} of {} bins in {}".format(feature_store.feature_type or 'unknown',
+                                                                   feature_store.feature_dim, args.feature_type,
+                                                                   feature_dim, args.feature_store))
+
+
+def check_shards(dataset, args):
+    """Returns whether features are extracted on device, from what the shards store:
+    audio shards (feature_dim 0) always are, feature shards never are.
+    """
+    if dataset.feature_dim == 0:
+        if args.feature_extraction != 'device':
+            print('Warning! {} stores audio, extracting features on device'.format(args.shards_dir))
+        return True
+    if dataset.feature_dim != get_feature_dim(args.feature_type):
+        raise ValueError("shards features should be {} of {} bins, but got "
+                         "feature_dim={} in {}".format(args.feature_type, get_feature_dim(args.feature_type),
+                                                       dataset.feature_dim, args.shards_dir))
+    if args.feature_extraction == 'device':
+        print('Warning! {} stores features, --feature_extraction device ignored'.format(args.shards_dir))
+    return False
+
+
+def main(args):
+    distributed = args.world_size > 1
+    if distributed:
+        torch.distributed.init_process_group(args.dist_backend, init_method=args.dist_url,
+                                             world_size=args.world_size, rank=args.rank)
+    if args.shards_dir:
+        # Sequential reads, shuffled by a buffer instead of a batch sampler, split between ranks
+        dataset = ShardedDataset(args.shards_dir, shuffle_buffer=args.shuffle_buffer, seed=args.seed,
+                                 num_replicas=args.world_size, rank=args.rank)
+        extract_on_device = check_shards(dataset, args)
+        collate_fn = TextWavCollate() if extract_on_device else TextAudioCollate()
+        data_loader = DataLoader(dataset, batch_size=args.batch_size,
+                                 collate_fn=collate_fn, num_workers=args.num_workers)
+    else:
+        # Precomputed features are never extracted again
+        extract_on_device = args.feature_extraction == 'device' and not args.feature_store
+        collate_fn = TextWavCollate() if extract_on_device else TextAudioCollate()
+        data_loader = build_data_loader(args, collate_fn, distributed)
     # Build model
 
     print(next(iter(data_loader)))
-    print("{} {} {}".format(hparams.num_chars, hparams.padding_idx, hparams.feature_dim))
+    feature_dim = get_feature_dim(args.feature_type)
+    print("{} {} {} {}".format(hparams.num_chars, hparams.padding_idx, feature_dim, args.feature_type))
     model = FeaturePredictNet(hparams.num_chars, hparams.padding_idx,
-                              hparams.feature_dim)
+                              feature_dim, feature_type=args.feature_type)
+    if args.attention_window:
+        model.decoder.attention.set_window(hparams.attention_window_backward, hparams.attention_window_forward)
     # print(model)
     if args.use_cuda:
         # model = torch.nn.DataParallel(model)
         model.cuda()
+    if distributed:
+        model = torch.nn.parallel.DistributedDataParallel(model)
     print(model)
     # Build criterion
     criterion = FeaturePredictNetLoss()
@@ -60,7 +167,8 @@ def main(args):
                                   weight_decay=args.l2,
                                   betas=(0.9, 0.999), eps=1e-6)
 
-    solver = Solver(data_loader, model, criterion, optimizier, args)
+    batch_transform = BatchFeatureExtractor(args.feature_type) if extract_on_device else None
+    solver = Solver(data_loader, model, criterion, optimizier, args, batch_transform=batch_transform)
     solver.train()
 
 if __name__ == '__main__':
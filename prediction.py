@@ -1,11 +1,15 @@
 import argparse 
-import os 
 import librosa
 import matplotlib.pyplot as plt 
 import torch
 
-from utils.audio_process import inv_spectrogram, save_wav
+import hyperparams as hparams
+from utils import torch_audio
+from utils.audio_writer import AsyncAudioWriter
 from src.model import FeaturePredictNet
+from src.quantize import quantize_model
+from src.scripted import load_scripted
+from src.synthesis_cache import SynthesisCache, checkpoint_hash
 from utils.text_process import text_to_sequence
 
 
@@ -19,36 +23,142 @@ def create_args():
     parser.add_argument('--text_file', type = str)
     parser.add_argument('--out_dir', type = str)
     parser.add_argument('--use_cuda', type = int)
+    parser.add_argument('--torchscript', type = int, default=0,
+                        help='model_path is a TorchScript artifact saved by export.py')
+    parser.add_argument('--quantize', type = int, default=0,
+                        help='Run an int8 copy of the checkpoint, CPU only, see src/quantize.py')
+    parser.add_argument('--attention_window', type = int, default=0,
+                        help='Windowed attention, see hparams.attention_window_backward/forward')
+    parser.add_argument('--fuse_attention', type = int, default=1,
+                        help='Attention U and location conv as one conv, 2-3x faster attention, '
+                             'outputs equal up to float rounding, see Decoder._fuse_location')
+    parser.add_argument('--griffin_lim', type = str, default='torch', choices=['torch', 'numpy'],
+                        help='torch runs batched fast Griffin-Lim on the model device in a writer thread, '
+                             'numpy is the librosa one in the writer processes; both overlap decoding, '
+                             'except torch with --cache, which vocodes misses before caching them')
+    parser.add_argument('--batch_size', type = int, default=8,
+                        help='Lines synthesized together, each line still gets its own wav')
+    parser.add_argument('--num_writers', type = int, default=2,
+                        help='Processes vocoding (numpy Griffin-Lim) and writing wavs while decoding')
+    parser.add_argument('--max_pending', type = int, default=8,
+                        help='Max utterances waiting for the writers, decoding blocks beyond it')
+    parser.add_argument('--cache', type = int, default=0,
+                        help='Serve repeated lines from a synthesis cache, see src/synthesis_cache.py')
+    parser.add_argument('--cache_dir', type = str, default=None,
+                        help='Disk tier of the synthesis cache, shared between runs of the same checkpoint')
+    parser.add_argument('--cache_memory_mb', type = int, default=256,
+                        help='Bound of features and PCM cached in memory, in MB')
+    parser.add_argument('--cache_disk_mb', type = int, default=2048,
+                        help='Bound of the disk tier, in MB')
     args = parser.parse_args()
     return args
 
 def synthesis(args):
 
-    model = FeaturePredictNet.load_model(args.model_path)
+    if args.torchscript:
+        model, config = load_scripted(args.model_path)
+        feature_type, quantized = config['feature_type'], config.get('quantized', False)
+        if args.attention_window:
+            print('Warning! TorchScript model uses attention over all encoder steps, --attention_window ignored')
+    else:
+        model = FeaturePredictNet.load_model(args.model_path)
+        feature_type, quantized = model.feature_type, bool(args.quantize)
+        if args.attention_window:
+            model.decoder.attention.set_window(hparams.attention_window_backward,
+                                               hparams.attention_window_forward)
+        if quantized:
+            model = quantize_model(model)
+        # int8 modules are not fused
+        model.decoder.fuse_attention = bool(args.fuse_attention) and not quantized
     model.eval()
-    model.cuda()
+    # Quantized kernels only run on CPU
+    if args.use_cuda and torch.cuda.is_available() and not quantized:
+        device = torch.device('cuda')
+    else:
+        if args.use_cuda:
+            print('Warning! Running on CPU, {}'.format(
+                'quantized model' if quantized else 'CUDA is not available'))
+        device = torch.device('cpu')
+    model.to(device)
 
-    os.makedirs(args.out_dir, exist_ok=True)
+    cache = None
+    if args.cache:
+        if args.torchscript:
+            print('Warning! Synthesis cache needs the checkpoint, not a TorchScript artifact, disabled')
+        else:
+            # quantized and windowed outputs differ from the plain ones
+            model_hash = checkpoint_hash(args.model_path) + ('-int8' if quantized else '') + \
+                ('-window{}-{}'.format(hparams.attention_window_backward, hparams.attention_window_forward)
+                 if args.attention_window else '')
+            cache = SynthesisCache(model, model_hash, memory_bytes=args.cache_memory_mb * 2 ** 20,
+                                   cache_dir=args.cache_dir, disk_bytes=args.cache_disk_mb * 2 ** 20)
+
+    def vocode_batch(feat_pred, output_lengths):
+        # batched torch Griffin-Lim of [N, To, D] features on the model device,
+        # no_grad again as it is thread local and this runs in the writer's vocoder thread
+        with torch.no_grad():
+            audios, audio_lengths = torch_audio.inv_spectrogram(feat_pred.transpose(1, 2), output_lengths,
+                                                                feature_type=feature_type)
+        audios = audios.cpu().numpy()
+        # copy, so a cached wav does not keep the whole batch alive
+        return [audios[i, :length].copy() for i, length in enumerate(audio_lengths.tolist())]
+
+    def vocode(features):
+        # list of [To, D] numpy features
+        feat_pred = torch.nn.utils.rnn.pad_sequence([torch.from_numpy(feature) for feature in features],
+                                                    batch_first=True).to(device)
+        output_lengths = torch.LongTensor([len(feature) for feature in features]).to(device)
+        return vocode_batch(feat_pred, output_lengths)
+
+    writer = AsyncAudioWriter(args.out_dir, num_workers=args.num_writers,
+                              max_pending=args.max_pending, feature_type=feature_type)
 
     # Did not use grad 
-    with torch.no_grad():
+    with torch.no_grad(), writer:
 
         with open(args.text_file, 'r') as text_file:
-            for i, text in enumerate(text_file.readlines()):
-                filename = str(i)
-                print(filename)
+            lines = text_file.readlines()
+        # Batches of lines in file order, so outputs are named by line number
+        for start in range(0, len(lines), args.batch_size):
+            texts = [torch.LongTensor(text_to_sequence(text)) for text in lines[start:start + args.batch_size]]
+            for i, text in enumerate(lines[start:start + args.batch_size]):
+                print(start + i)
                 print(text)
-                text = torch.LongTensor(text_to_sequence(text)).unsqueeze(0)
-                input_length = torch.LongTensor([text.size(-1)])
-                text, input_length = text.cuda(), input_length.cuda()
-                outputs = model.inference(text, input_length)
-                feat_outputs, feat_residual_outputs, _, attention_weights = outputs
-                feat_pred = feat_outputs + feat_residual_outputs
-                
-                audio = inv_spectrogram(feat_pred[0].cpu().numpy().T)
-                audio_path = os.path.join(args.out_dir, f'{filename}.wav')
+            if cache is not None:
+                sequences = [text.tolist() for text in texts]
+                if args.griffin_lim == 'torch':
+                    vocoder = 'torch_griffin_lim-{}-{}'.format(hparams.torch_griffin_lim_iters,
+                                                                 hparams.griffin_lim_momentum)
+                    for i, wav in enumerate(cache.wavs(sequences, vocode, vocoder)):
+                        print(writer.submit_wav(str(start + i), wav))
+                else:
+                    for i, feature in enumerate(cache.inference(sequences)):
+                        print(writer.submit(str(start + i), feature.T))
+                continue
+            input_lengths = torch.LongTensor([len(text) for text in texts])
+            text_padded = torch.full((len(texts), int(input_lengths.max())), hparams.padding_idx, dtype=torch.long)
+            for i, text in enumerate(texts):
+                text_padded[i, :len(text)] = text
+            text_padded, input_lengths = text_padded.to(device), input_lengths.to(device)
+            if args.torchscript:
+                feat_outputs, feat_residual_outputs, output_lengths = model(text_padded, input_lengths)
+            else:
+                outputs = model.inference(text_padded, input_lengths, return_attention=False)
+                feat_outputs, feat_residual_outputs, _, _, output_lengths = outputs
+            feat_pred = feat_outputs + feat_residual_outputs
+
+            if args.griffin_lim == 'torch':
+                # vocoded by the writer's vocoder thread, while we decode the next lines
+                names = [str(start + i) for i in range(len(texts))]
+                for audio_path in writer.submit_vocode(names, vocode_batch, feat_pred, output_lengths):
+                    print(audio_path)
+                continue
+            for i in range(len(texts)):
+                # vocoded by the writers, while we decode the next lines
+                audio_path = writer.submit(str(start + i), feat_pred[i, :output_lengths[i]].cpu().numpy().T)
                 print(audio_path)
-                save_wav(audio, audio_path)
+    if cache is not None:
+        print('Synthesis cache: {}'.format(dict(cache.stats)))
 
 def main():
     args =  create_args()
@@ -0,0 +1,52 @@
+import argparse
+
+import hyperparams as hparams
+from utils.audio_process import FEATURE_TYPES, get_feature_extractor
+from utils.data import read_metadata
+from utils.feature_store import write_feature_store
+from utils.shards import write_shards
+from utils.text_process import text_to_sequence
+
+parser = argparse.ArgumentParser("Tacotron2 feature extraction")
+parser.add_argument('--train_dir', type=str, required=True, help='dir including wav')
+parser.add_argument('--train_csv', type=str, default='metadata.csv', help='csv file such metadata.csv')
+parser.add_argument('--store_dir', type=str, required=True, help='Dir to save extracted features or shards')
+parser.add_argument('--format', default='memmap', choices=['memmap', 'shards'],
+                    help='memmap: one memory-mapped feature file, shards: sequential shard files')
+parser.add_argument('--shard_content', default='features', choices=['features', 'audio'],
+                    help='Pack features or raw audio into shards')
+parser.add_argument('--shard_size', default=256, type=int, help='Approximate size of a shard in MB')
+parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'],
+                    help='Storage type of features, float16 halves the store size')
+parser.add_argument('--feature_type', default=hparams.feature_type, choices=FEATURE_TYPES,
+                    help='linear spectrogram or mel spectrogram features')
+parser.add_argument('--num_workers', default=4, type=int, help='Number of extraction processes')
+
+
+def main(args):
+    metadata = read_metadata(args.train_csv)
+    wav_ids = metadata['wav'].tolist()
+    print(len(wav_ids))
+    if args.format == 'shards':
+        audio_transformer = get_feature_extractor(args.feature_type) if args.shard_content == 'features' else None
+        num_shards = write_shards(args.store_dir, args.train_dir, wav_ids,
+                                  metadata['norm_text'].tolist(),
+                                  text_transformer=text_to_sequence,
+                                  audio_transformer=audio_transformer,
+                                  sample_rate=hparams.sample_rate, shard_size=args.shard_size,
+                                  dtype=args.dtype, num_workers=args.num_workers)
+        print('Saved {} records in {} shards to {}'.format(len(wav_ids), num_shards, args.store_dir))
+        return
+    store = write_feature_store(args.store_dir, args.train_dir, wav_ids,
+                                audio_transformer=get_feature_extractor(args.feature_type),
+                                sample_rate=hparams.sample_rate,
+                                dtype=args.dtype, num_workers=args.num_workers,
+                                feature_type=args.feature_type)
+    print('Saved {} features ({} frames) to {}'.format(
+        len(store), int(store.lengths.sum()), args.store_dir))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
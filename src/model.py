@@ -11,6 +11,9 @@ class FeaturePredictNet(nn.Module):
     """Recurrent sequence-to-sequence feature prediction network with attention
     which predicts a sequence of (mel) spectrogram frames from an input character
     sequence.
+
+    feature_type ('linear' or 'mel') is only recorded, so a checkpoint knows how
+    to turn its predictions back into audio. feature_dim should match it.
     """
     def __init__(self, num_chars, padding_idx, feature_dim,
                  embedding_dim=512, encoder_num_convs=3, kernel_size=5,
@@ -18,10 +21,11 @@ class FeaturePredictNet(nn.Module):
                  prenet_dim=256, decoder_hidden_size=1024,
                  attention_dim=128, location_feature_dim=32,
                  postnet_num_convs=5, postnet_filter_size=512, postnet_kernel_size=5,
-                 max_decoder_steps=1000):
+                 max_decoder_steps=1000, feature_type='linear'):
         super(FeaturePredictNet, self).__init__()
         # Hyperparameter
         self.num_chars, self.padding_idx, self.feature_dim = num_chars, padding_idx, feature_dim
+        self.feature_type = feature_type
         self.embedding_dim = embedding_dim
         self.encoder_num_convs, self.kernel_size = encoder_num_convs, kernel_size
         self.encoder_hidden_size, self.bidirectional = encoder_hidden_size, bidirectional
@@ -40,17 +44,34 @@ class FeaturePredictNet(nn.Module):
 
 
 
-    def forward(self, text_padded, input_lengths, feat_padded, encoder_mask, decoder_mask):
+    def forward(self, text_padded, input_lengths, feat_padded, encoder_mask, decoder_mask,
+                return_attention=True):
         encoder_padded_outputs = self.encoder(text_padded, input_lengths)
         feat_outputs, feat_residual_outputs, stop_tokens, attention_weights \
-            = self.decoder(encoder_padded_outputs, encoder_mask, feat_padded, decoder_mask)
+            = self.decoder(encoder_padded_outputs, encoder_mask, feat_padded, decoder_mask, return_attention)
         return feat_outputs, feat_residual_outputs, stop_tokens, attention_weights
 
-    def inference(self, text_padded, input_lengths):
+    def inference(self, text_padded, input_lengths, return_attention=True):
+        """Inference a batch of padded texts, in any order of lengths.
+        Returns:
+            feat_outputs, feat_residual_outputs: [N, To, D], 0 after output_lengths
+            stop_tokens: [N, To]
+            attention_weights: [N, To, Ti], None if not return_attention
+            output_lengths: [N]
+        """
         encoder_padded_outputs = self.encoder(text_padded, input_lengths)
-        feat_outputs, feat_residual_outputs, stop_tokens, attention_weights \
-            = self.decoder.inference(encoder_padded_outputs)
-        return feat_outputs, feat_residual_outputs, stop_tokens, attention_weights
+        Ti = encoder_padded_outputs.size(1)
+        encoder_mask = torch.arange(Ti, device=text_padded.device).unsqueeze(0) >= \
+            input_lengths.to(text_padded.device).unsqueeze(1)  # [N, Ti], True at padding
+        return self.decoder.inference(encoder_padded_outputs, encoder_mask, return_attention)
+
+    def inference_stream(self, text_padded, input_lengths, chunk_frames=16):
+        """Same as inference, but yields frames in chunks while decoding, see Decoder.inference_stream"""
+        encoder_padded_outputs = self.encoder(text_padded, input_lengths)
+        Ti = encoder_padded_outputs.size(1)
+        encoder_mask = torch.arange(Ti, device=text_padded.device).unsqueeze(0) >= \
+            input_lengths.to(text_padded.device).unsqueeze(1)  # [N, Ti], True at padding
+        return self.decoder.inference_stream(encoder_padded_outputs, encoder_mask, chunk_frames)
 
     @classmethod
     def load_model(cls, path):
@@ -66,7 +87,9 @@ class FeaturePredictNet(nn.Module):
                     package['encoder_hidden_size'], package['bidirectional'],
                     package['prenet_dim'], package['decoder_hidden_size'],
                     package['attention_dim'], package['location_feature_dim'],
-                    package['postnet_num_convs'], package['postnet_filter_size'], package['postnet_kernel_size'])
+                    package['postnet_num_convs'], package['postnet_filter_size'], package['postnet_kernel_size'],
+                    # checkpoints before mel support are linear
+                    feature_type=package.get('feature_type', 'linear'))
         model.load_state_dict(package['state_dict'])
         return model
 
@@ -80,6 +103,7 @@ class FeaturePredictNet(nn.Module):
             'prenet_dim': model.prenet_dim, 'decoder_hidden_size': model.decoder_hidden_size,
             'attention_dim': model.attention_dim, 'location_feature_dim': model.location_feature_dim,
             'postnet_num_convs': model.postnet_num_convs, 'postnet_filter_size': model.postnet_filter_size, 'postnet_kernel_size': model.postnet_kernel_size,
+            'feature_type': model.feature_type,
             # state
             'state_dict': model.state_dict(),
             'optim_dict': optimizer.state_dict(),
@@ -119,11 +143,15 @@ class Encoder(nn.Module):
         """
         x = self.embedding(text_padded) # [N, T, D]
         x = x.transpose(1, 2)
-        x = self.convs(x)
+        # Zero padding between convs, so an utterance is encoded the same in any batch
+        mask = (torch.arange(x.size(-1), device=x.device).unsqueeze(0) >=
+                input_lengths.to(x.device).unsqueeze(1)).unsqueeze(1)  # [N, 1, T]
+        for conv in self.convs:
+            x = conv(x).masked_fill(mask, 0.0)
         x = x.transpose(1, 2)
 
         total_length = x.size(1) 
-        packed_input = pack_padded_sequence(x, input_lengths, batch_first=True)
+        packed_input = pack_padded_sequence(x, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
 
         self.rnn.flatten_parameters()
         packed_output, _ = self.rnn(packed_input)
@@ -142,6 +170,8 @@ class Decoder(nn.Module):
         self.encoder_hidden_size = encoder_hidden_size
         self.decoder_hidden_size = decoder_hidden_size
         self.max_decoder_steps = max_decoder_steps
+        # Without autograd, attention runs U∘F as one location conv, see _fuse_location
+        self.fuse_attention = False
             
 
         self.prenet = PreNet(feature_dim, prenet_dim)
@@ -158,7 +188,7 @@ class Decoder(nn.Module):
         self.postnet = PostNet(feature_dim, postnet_num_convs, postnet_filter_size, postnet_kernel_size)
         
 
-    def forward(self, encoder_padded_outputs, encoder_mask, feat_padded, decoder_mask):
+    def forward(self, encoder_padded_outputs, encoder_mask, feat_padded, decoder_mask, return_attention=True):
         # Create empty tensor of encoder padded output shape 
         go_frame = self._init_go_frame(encoder_padded_outputs)
         expand_feat = torch.cat((go_frame, feat_padded), dim=1) #[N, To+1, D]
@@ -169,8 +199,8 @@ class Decoder(nn.Module):
 
         # Forward part 
 
-        feat_outputs, stop_tokens, attention_weights = [], [], [] 
         To = feat_padded.size(1)
+        outputs = _StepOutputs(To, return_attention)
         
         prenet_out = self.prenet(expand_feat)
         
@@ -178,14 +208,9 @@ class Decoder(nn.Module):
             if t == 0:
                 self.attention.reset()
             step_input = prenet_out[:, t, :]
-            feat_output, stop_token, attention_weight = self._step(step_input)
-            feat_outputs += [feat_output]
-            stop_tokens += [stop_token]
-            attention_weights += [attention_weight]
+            outputs.append(*self._step(step_input))
             
-        feat_outputs = torch.stack(feat_outputs, dim=1)
-        stop_tokens = torch.stack(stop_tokens, dim=1).squeeze()
-        attention_weights = torch.stack(attention_weights, dim=1)
+        feat_outputs, stop_tokens, attention_weights = outputs.get()
         feat_residual_outputs = self.postnet(feat_outputs)
 
 
@@ -196,39 +221,119 @@ class Decoder(nn.Module):
         stop_tokens = stop_tokens.masked_fill(decoder_mask.squeeze(), 1e3)
         return feat_outputs, feat_residual_outputs, stop_tokens, attention_weights
 
-    def inference(self, encoder_padded_outputs):
-        """Inference one utterance."""
+    def inference(self, encoder_padded_outputs, encoder_mask=None, return_attention=True):
+        """Inference a batch of utterances. Each row finishes at its own stop
+        token; the loop runs until every row has finished, and later outputs of
+        finished rows are masked, so every row is the same as inferring it alone.
+        Args:
+            encoder_padded_outputs: [N, Ti, He]
+            encoder_mask: [N, Ti], True at padding, None if nothing is padded
+            return_attention: False does not keep attention weights
+        Returns:
+            feat_outputs, feat_residual_outputs: [N, To, D], 0 after output_lengths
+            stop_tokens: [N, To]
+            attention_weights: [N, To, Ti], None if not return_attention
+            output_lengths: [N]
+        """
         # Init
+        N = encoder_padded_outputs.size(0)
         # get go frame
         go_frame = self._init_go_frame(encoder_padded_outputs).squeeze(1)
         # init rnn state and attention
         self._init_state(encoder_padded_outputs)
-        self.encoder_mask = None
+        self.encoder_mask = encoder_mask
+        output_lengths = encoder_padded_outputs.new_full((N,), self.max_decoder_steps, dtype=torch.long)
+        finished = encoder_padded_outputs.new_zeros(N, dtype=torch.bool)
 
         # Forward
-        feat_outputs, stop_tokens, attention_weights = [], [], []
+        # utterances are ~5 frames per character, grow from there if needed
+        outputs = _StepOutputs(min(self.max_decoder_steps, 8 * encoder_padded_outputs.size(1)), return_attention)
         step_input = go_frame
         self.attention.reset()
         while True:
             step_input = self.prenet(step_input)
             feat_output, stop_token, attention_weight = self._step(step_input)
             # record
-            feat_outputs += [feat_output]
-            stop_tokens += [stop_token]
-            attention_weights += [attention_weight]
+            outputs.append(feat_output, stop_token, attention_weight)
             # terminate?
-            if torch.sigmoid(stop_token) > 0.5:
+            stop = (torch.sigmoid(stop_token.squeeze(1)) > 0.5) & ~finished
+            output_lengths = output_lengths.masked_fill(stop, len(outputs))
+            finished = finished | stop
+            if finished.all():
                 break
-            elif len(feat_outputs) == self.max_decoder_steps:
+            elif len(outputs) == self.max_decoder_steps:
                 print("Warning! Reached max decoder steps")
                 break
             # autoregressive
             step_input = feat_output
-        feat_outputs = torch.stack(feat_outputs, dim=1)
-        stop_tokens = torch.stack(stop_tokens, dim=1).squeeze()
-        attention_weights = torch.stack(attention_weights, dim=1)
-        feat_residual_outputs = self.postnet(feat_outputs)
-        return feat_outputs, feat_residual_outputs, stop_tokens, attention_weights
+        feat_outputs, stop_tokens, attention_weights = outputs.get()
+
+        # Mask steps after the end of each row
+        To = feat_outputs.size(1)
+        decoder_mask = torch.arange(To, device=output_lengths.device).unsqueeze(0) >= output_lengths.unsqueeze(1)
+        feat_outputs = feat_outputs.masked_fill(decoder_mask.unsqueeze(-1), 0.0)
+        stop_tokens = stop_tokens.masked_fill(decoder_mask, 1e3)
+        if attention_weights is not None:
+            attention_weights = attention_weights.masked_fill(decoder_mask.unsqueeze(-1), 0.0)
+        feat_residual_outputs = self.postnet(feat_outputs, decoder_mask)
+        return feat_outputs, feat_residual_outputs, stop_tokens, attention_weights, output_lengths
+
+    def inference_stream(self, encoder_padded_outputs, encoder_mask=None, chunk_frames=16):
+        """Same as inference, but a generator of frames in chunks while decoding.
+        PostNet runs incrementally (StreamingPostNet), so a frame is yielded
+        once the PostNet lookahead frames after it are decoded, and the frames
+        of all chunks concatenated are the same as inference outputs.
+        Args:
+            encoder_padded_outputs: [N, Ti, He]
+            encoder_mask: [N, Ti], True at padding, None if nothing is padded
+            chunk_frames (int): decoder steps between PostNet updates
+        Yields:
+            feat_outputs, feat_residual_outputs: [N, t, D], the next t frames, 0 after output_lengths
+            output_lengths: [N], of the rows finished so far, max_decoder_steps for the others
+        """
+        if chunk_frames < 1:
+            raise ValueError("chunk_frames should be >= 1, but got "
+                             "chunk_frames={}".format(chunk_frames))
+        N = encoder_padded_outputs.size(0)
+        go_frame = self._init_go_frame(encoder_padded_outputs).squeeze(1)
+        self._init_state(encoder_padded_outputs)
+        self.encoder_mask = encoder_mask
+        output_lengths = encoder_padded_outputs.new_full((N,), self.max_decoder_steps, dtype=torch.long)
+        finished = encoder_padded_outputs.new_zeros(N, dtype=torch.bool)
+
+        postnet = StreamingPostNet(self.postnet)
+        chunk, chunk_mask = [], []  # decoded frames not in PostNet yet, and True after the end of a row
+        waiting = None  # [N, T, D], frames in PostNet, waiting for their residual
+        step_input = go_frame
+        self.attention.reset()
+        steps = 0
+        while True:
+            step_input = self.prenet(step_input)
+            feat_output, stop_token, _ = self._step(step_input)
+            steps += 1
+            # frames of finished rows are 0, as inference masks them
+            chunk += [feat_output.masked_fill(finished.unsqueeze(1), 0.0)]
+            chunk_mask += [finished]
+            stop = (torch.sigmoid(stop_token.squeeze(1)) > 0.5) & ~finished
+            output_lengths = output_lengths.masked_fill(stop, steps)
+            finished = finished | stop
+            done = bool(finished.all()) or steps == self.max_decoder_steps
+            if done and not finished.all():
+                print("Warning! Reached max decoder steps")
+            if len(chunk) == chunk_frames or done:
+                feat_outputs = torch.stack(chunk, dim=1)
+                waiting = feat_outputs if waiting is None else torch.cat((waiting, feat_outputs), dim=1)
+                feat_residual_outputs = postnet.push(feat_outputs, torch.stack(chunk_mask, dim=1))
+                chunk, chunk_mask = [], []
+                if feat_residual_outputs.size(1) > 0:
+                    T = feat_residual_outputs.size(1)
+                    yield waiting[:, :T], feat_residual_outputs, output_lengths
+                    waiting = waiting[:, T:]
+            if done:
+                break
+            # autoregressive
+            step_input = feat_output
+        yield waiting, postnet.flush(), output_lengths
 
 
     def _init_go_frame(self, tensor):
@@ -250,6 +355,21 @@ class Decoder(nn.Module):
         self.attention_context = encoder_padded_outputs.new_zeros(N, self.encoder_hidden_size)
         # Keep encoder_padded_outputs
         self.encoder_padded_outputs = encoder_padded_outputs
+        # U∘F of the current weights at every utterance, so never stale, see _fuse_location
+        self.fused_location = self._fuse_location(Ti) if self.fuse_attention and not torch.is_grad_enabled() \
+            else None
+
+    def _fuse_location(self, Ti):
+        """Location conv weight of LocationSensitiveAttention.fused_forward, see fuse_location.
+        None when the attention is windowed for Ti encoder steps, the window has its own path.
+        """
+        attention = self.attention
+        if type(attention.U) is not nn.Linear or type(attention.v) is not nn.Linear:
+            raise ValueError("fuse_attention needs float nn.Linear attention U and v, but got "
+                             "U={}, v={}".format(type(attention.U), type(attention.v)))
+        if 0 < attention.window_size < Ti:
+            return None
+        return attention.fuse_location()
 
     def _step(self, step_input):
         # decoder RNN: s_i = RNN(s_i−1,y_i−1,c_i−1)
@@ -258,10 +378,15 @@ class Decoder(nn.Module):
         self.h_list[1], self.c_list[1] = self.rnn[1](self.h_list[0], (self.h_list[1], self.c_list[1]))
         rnn_output = self.h_list[1]
         # attention: c_i = LocationSensitiveAttention(s_i, h, ca_i-1)
-        self.attention_context, attention_weight = self.attention(rnn_output,
-                                                                  self.encoder_padded_outputs,
-                                                                  self.cumulative_attention_weight,
-                                                                  mask=self.encoder_mask)
+        if self.fused_location is not None:
+            self.attention_context, attention_weight = self.attention.fused_forward(
+                self.attention.W(rnn_output), self.encoder_padded_outputs, self.cumulative_attention_weight,
+                self.fused_location, mask=self.encoder_mask)
+        else:
+            self.attention_context, attention_weight = self.attention(rnn_output,
+                                                                      self.encoder_padded_outputs,
+                                                                      self.cumulative_attention_weight,
+                                                                      mask=self.encoder_mask)
         # NOTE HERE!!! Here maybe exists a bug?
         # Below causa issue "one of the variables needed for gradient computation has been modified by an inplace operation"
         # cumulative_attention_weight += attention_weight
@@ -273,6 +398,71 @@ class Decoder(nn.Module):
         stop_token = self.stop_linear(linear_input)
         return feat_output, stop_token, attention_weight
 
+class _StepOutputs(object):
+    """Collects the (feat_output, stop_token, attention_weight) of every decoder step.
+
+    Without autograd, steps are written into preallocated buffers of capacity
+    steps, doubled when full, so a loop does not keep one small tensor per step
+    and a copy of all of them at the end. With autograd, steps are stacked once
+    at the end instead: a backward through per-step writes into one buffer
+    copies the whole buffer at every step.
+    """
+    def __init__(self, capacity, keep_attention=True):
+        self.capacity = max(capacity, 1)
+        self.keep_attention = keep_attention
+        self.preallocate = not torch.is_grad_enabled()
+        self.steps = 0
+        self.feat_outputs, self.stop_tokens, self.attention_weights = None, None, None
+
+    def __len__(self):
+        return self.steps
+
+    def append(self, feat_output, stop_token, attention_weight):
+        """feat_output: [N, D], stop_token: [N, 1], attention_weight: [N, Ti]"""
+        if not self.keep_attention:
+            attention_weight = None
+        if not self.preallocate:
+            if self.steps == 0:
+                self.feat_outputs, self.stop_tokens, self.attention_weights = [], [], []
+            self.feat_outputs += [feat_output]
+            self.stop_tokens += [stop_token.squeeze(1)]
+            self.attention_weights += [attention_weight]
+        else:
+            if self.steps == 0:
+                self.feat_outputs = feat_output.new_empty(feat_output.size(0), self.capacity, feat_output.size(1))
+                self.stop_tokens = stop_token.new_empty(stop_token.size(0), self.capacity)
+                if attention_weight is not None:
+                    self.attention_weights = attention_weight.new_empty(
+                        attention_weight.size(0), self.capacity, attention_weight.size(1))
+            elif self.steps == self.capacity:
+                self.feat_outputs = self._grow(self.feat_outputs)
+                self.stop_tokens = self._grow(self.stop_tokens)
+                if self.attention_weights is not None:
+                    self.attention_weights = self._grow(self.attention_weights)
+                self.capacity *= 2
+            self.feat_outputs[:, self.steps] = feat_output
+            self.stop_tokens[:, self.steps] = stop_token.squeeze(1)
+            if attention_weight is not None:
+                self.attention_weights[:, self.steps] = attention_weight
+        self.steps += 1
+
+    def _grow(self, buffer):
+        return torch.cat((buffer, buffer.new_empty(buffer.size())), dim=1)
+
+    def get(self):
+        """
+        Returns:
+            feat_outputs: [N, T, D]
+            stop_tokens: [N, T]
+            attention_weights: [N, T, Ti], None if not keep_attention
+        """
+        if not self.preallocate:
+            attention_weights = torch.stack(self.attention_weights, dim=1) if self.keep_attention else None
+            return torch.stack(self.feat_outputs, dim=1), torch.stack(self.stop_tokens, dim=1), attention_weights
+        attention_weights = self.attention_weights[:, :self.steps] if self.keep_attention else None
+        return self.feat_outputs[:, :self.steps], self.stop_tokens[:, :self.steps], attention_weights
+
+
 class PreNet(nn.Module):
     """The prediction from the previous time step is first passed through a small pre-net containing 2 fully connected layers of 256 hidden ReLU units. We found that the pre-net acting as an information bottleneck was essential for learning attention."""
     def __init__(self, feature_dim, prenet_dim=256, p=0.5):
@@ -304,11 +494,28 @@ class LocationSensitiveAttention(nn.Module):
                            kernel_size=31, stride=1, padding=(31-1)//2,
                            bias=False)
         self.v = nn.Linear(attention_dim, 1, bias=False)
+        self.set_window(0, 0)
         self.reset()
 
     def reset(self):
         """Remember to reset at decoder step 0"""
         self.Vh = None # pre-compute V*h_j due to it is independent from the decoding step i
+        self.VhT = None # [N, A, Ti], V*h_j of fused_forward
+        self.peak = None # [N], encoder step of the previous attention peak, for windowed attention
+
+    def set_window(self, backward, forward):
+        """Windowed attention: energies only over the encoder steps
+        [peak - backward, peak + forward] around the previous attention peak
+        (shifted to stay in the encoder outputs, from step 0 at decoder step 0),
+        0 elsewhere. The location conv, U, tanh and v run over the window only,
+        so the cost of a step does not depend on the text length.
+        backward = forward = 0 is attention over all encoder steps.
+        """
+        if backward < 0 or forward < 0:
+            raise ValueError("window should be >= 0, but got "
+                             "backward={}, forward={}".format(backward, forward))
+        self.window_backward, self.window_forward = backward, forward
+        self.window_size = backward + forward + 1 if backward + forward > 0 else 0
 
     def _cal_energy(self, query, values, cumulative_attention_weights, mask=None):
         """Calculate energy:
@@ -351,6 +558,8 @@ class LocationSensitiveAttention(nn.Module):
             attention_context: [N, He]
             attention_weights: [N, Ti]
         """
+        if 0 < self.window_size < values.size(1):
+            return self._window_forward(query, values, cumulative_attention_weights, mask)
         energies = self._cal_energy(query, values, cumulative_attention_weights, mask) #[N, Ti]
         attention_weights = F.softmax(energies, dim=1) #[N, Ti]
         # print('weights', attention_weights)
@@ -359,6 +568,67 @@ class LocationSensitiveAttention(nn.Module):
         # print('context', attention_context.size())
         return attention_context, attention_weights
 
+    def fuse_location(self):
+        """U∘F as one conv weight [A, 1, K]: U (F * ca) = (U∘F) * ca, both are linear without bias"""
+        return torch.einsum('al,lik->aik', self.U.weight, self.F.weight)
+
+    def fused_forward(self, Ws, values, cumulative_attention_weights, location_weight, mask=None):
+        """forward without autograd, with W s_i given and U∘F as one location conv.
+        Energies are [N, A, Ti], as the conv outputs, so nothing is transposed.
+        Args:
+            Ws: [N, A], W s_i + b
+            location_weight: [A, 1, K], see fuse_location
+        Returns:
+            attention_context: [N, He]
+            attention_weights: [N, Ti]
+        """
+        if self.VhT is None:
+            self.VhT = self.V(values).transpose(1, 2).contiguous() #[N, A, Ti]
+        energies = F.conv1d(cumulative_attention_weights.unsqueeze(1), location_weight,
+                            padding=self.F.padding[0]) #[N, A, Ti], U f_ij
+        energies += self.VhT
+        energies += Ws.unsqueeze(2)
+        energies = torch.matmul(self.v.weight, energies.tanh_()).squeeze(1) #[1, A] x [N, A, Ti] -> [N, Ti]
+        if mask is not None:
+            energies = energies.masked_fill(mask, -np.inf)
+        attention_weights = F.softmax(energies, dim=1) #[N, Ti]
+        attention_context = torch.bmm(attention_weights.unsqueeze(1), values).squeeze(1) #[N, He]
+        return attention_context, attention_weights
+
+    def _window_forward(self, query, values, cumulative_attention_weights, mask=None):
+        """forward over a window of W = window_size encoder steps, see set_window
+        Returns:
+            attention_context: [N, He]
+            attention_weights: [N, Ti], 0 outside of the window
+        """
+        N, Ti = cumulative_attention_weights.size()
+        if self.peak is None:
+            self.peak = cumulative_attention_weights.new_zeros(N, dtype=torch.long)
+        start = (self.peak - self.window_backward).clamp(0, Ti - self.window_size)
+        positions = start.unsqueeze(1) + torch.arange(self.window_size, device=start.device)  # [N, W]
+        Ws = self.W(query.unsqueeze(1)) #[N, 1, A]
+        if self.Vh is None:
+            self.Vh = self.V(values) #[N, Ti, A]
+        Vh = self.Vh.gather(1, positions.unsqueeze(2).expand(-1, -1, self.Vh.size(2))) #[N, W, A]
+        # location conv over the window and its receptive field, 0 outside of
+        # the encoder steps as the conv padding
+        padding = self.F.padding[0]
+        field = (start - padding).unsqueeze(1) + \
+            torch.arange(self.window_size + 2 * padding, device=start.device)  # [N, W + 2P]
+        inside = (field >= 0) & (field < Ti)
+        cumulative = cumulative_attention_weights.gather(1, field.clamp(0, Ti - 1)) * inside
+        location_feature = F.conv1d(cumulative.unsqueeze(1), self.F.weight) #[N, 32, W]
+        Uf = self.U(location_feature.transpose(1, 2)) #[N, W, A]
+        energies = self.v(torch.tanh(Ws + Vh + Uf)).squeeze(-1) #[N, W]
+        if mask is not None:
+            energies = energies.masked_fill(mask.gather(1, positions), -np.inf)
+        window_weights = F.softmax(energies, dim=1) #[N, W]
+        window_values = values.gather(1, positions.unsqueeze(2).expand(-1, -1, values.size(2))) #[N, W, He]
+        attention_context = torch.bmm(window_weights.unsqueeze(1), window_values).squeeze(1) #[N, He]
+        attention_weights = window_weights.new_zeros(N, Ti).scatter(1, positions, window_weights)
+        self.peak = positions.gather(1, window_weights.argmax(dim=1, keepdim=True)).squeeze(1)
+        return attention_context, attention_weights
+
 
 class PostNet(nn.Module):
     """Finally, the predicted mel spectrogram is passed through a 5-layer convolutional post-net which predicts a residual to add to the prediction to improve the overall reconstruction. Each post-net layer is comprised of 512 filters with shape 5 × 1 with batch normalization, followed by tanh activations on all but the final layer."""
@@ -371,19 +641,90 @@ class PostNet(nn.Module):
         convs += [ConvBlock(postnet_filter_size, feature_dim, postnet_kernel_size, padding, None)]
         self.convs = nn.Sequential(*convs)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         """
         Args:
             x: [N, T, D]
+            mask: [N, T], True at padding. Padding frames are zeroed between
+                layers, as the conv padding does at the end of a single utterance
         Returns:
             out = [N, T, D]
         """
         x = x.transpose(1, 2)
-        out = self.convs(x)
+        if mask is None:
+            out = self.convs(x)
+        else:
+            mask = mask.unsqueeze(1)  # [N, 1, T]
+            out = x
+            for conv in self.convs:
+                out = conv(out).masked_fill(mask, 0.0)
         out = out.transpose(1, 2)
         return out
 
 
+class StreamingPostNet(object):
+    """PostNet over frames arriving in chunks, each residual frame is the same
+    as PostNet over the whole sequence.
+
+    A layer with kernel size k (padding p = (k - 1) // 2) needs p input frames
+    after an output frame, so with 5 layers of k = 5 a residual frame is
+    complete 10 frames after its input (lookahead). Each layer keeps a buffer
+    of the input frames still needed: p frames of left context (zeros at the
+    start, as the conv padding) and the frames waiting for their lookahead.
+    `flush` pads p zero frames after the end at each layer, as the conv padding.
+
+    Args:
+        postnet: PostNet in eval mode, its convs are shared
+    """
+    def __init__(self, postnet):
+        self.convs = postnet.convs
+        self.padding = (self.convs[0].net[0].kernel_size[0] - 1) // 2
+        self.lookahead = self.padding * len(self.convs)
+        self.buffers = [None] * len(self.convs)  # [N, C, T], input frames of each layer not consumed yet
+        self.positions = [0] * len(self.convs)  # output frames of each layer so far
+        self.mask = None  # [N, T], True after the end of a row, as PostNet mask
+
+    def push(self, x, mask):
+        """
+        Args:
+            x: [N, T, D], next frames, 0 after the end of a row
+            mask: [N, T], True after the end of a row
+        Returns:
+            residual: [N, T', D], of the next frames whose lookahead is complete, T' may be 0
+        """
+        self.mask = mask if self.mask is None else torch.cat((self.mask, mask), dim=1)
+        return self._run(x.transpose(1, 2), final=False).transpose(1, 2)
+
+    def flush(self):
+        """Returns the residual [N, T', D] of the remaining frames, after the last push"""
+        return self._run(None, final=True).transpose(1, 2)
+
+    def _run(self, x, final):
+        p = self.padding
+        for l, block in enumerate(self.convs):
+            buffer = self.buffers[l]
+            if buffer is None:
+                buffer = x.new_zeros(x.size(0), x.size(1), p)  # left conv padding
+            inputs = [buffer] if x is None else [buffer, x]
+            if final:
+                inputs += [buffer.new_zeros(buffer.size(0), buffer.size(1), p)]  # right conv padding
+            x = torch.cat(inputs, dim=2)
+            T = x.size(2) - 2 * p  # frames with full context
+            if T <= 0:
+                self.buffers[l] = x
+                x = x.new_zeros(x.size(0), block.net[0].out_channels, 0)  # nothing for the next layer yet
+                continue
+            self.buffers[l] = x[:, :, T:]
+            conv = block.net[0]
+            out = F.conv1d(x, conv.weight, conv.bias, conv.stride, 0, conv.dilation)
+            for layer in block.net[1:]:
+                out = layer(out)
+            start = self.positions[l]
+            x = out.masked_fill(self.mask[:, start:start + T].unsqueeze(1), 0.0)
+            self.positions[l] += T
+        return x
+
+
 class ConvBlock(nn.Module):
     """Conv1d -> BatchNorm1d -> (nonlinear) -> Dropout"""
     def __init__(self, in_channels, out_channels, kernel_size, padding, nonlinear=None):
@@ -0,0 +1,89 @@
+"""
+Int8 CPU inference of FeaturePredictNet.
+
+Logic:
+- BatchNorm of every ConvBlock (Encoder and PostNet) is folded into its conv
+  with the running statistics, so eval convs are one op.
+- Dynamic quantization: int8 weights, activations quantized on the fly, for
+  the decoder LSTMCells, the attention projections, the PreNet and
+  feature_linear, i.e. nearly all weights of a decoder step. stop_linear stays
+  float, a flipped stop decision costs more than its tiny matmul.
+- `compare_quantized` measures the error of a quantized model against the
+  float one, teacher-forced on the float outputs so both decode the same frames.
+
+The quantized model only runs on CPU; save it with src.scripted.export_scripted.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from src.model import ConvBlock
+
+QUANTIZED_MODULES = {
+    'decoder.rnn.0', 'decoder.rnn.1',
+    'decoder.attention.W', 'decoder.attention.V', 'decoder.attention.U', 'decoder.attention.v',
+    'decoder.prenet.linear1', 'decoder.prenet.linear2',
+    'decoder.feature_linear',
+}
+
+
+def fold_batchnorm(model):
+    """Fold BatchNorm1d into the conv of every ConvBlock of model, in place.
+    Only valid for inference, model must be in eval mode.
+    """
+    for module in model.modules():
+        if isinstance(module, ConvBlock):
+            conv, norm = module.net[0], module.net[1]
+            if isinstance(norm, nn.BatchNorm1d):
+                module.net[0] = fuse_conv_bn_eval(conv, norm)
+                module.net[1] = nn.Identity()
+    return model
+
+
+def quantize_model(model):
+    """Returns an int8 copy of model (FeaturePredictNet) for CPU inference"""
+    model = copy.deepcopy(model).cpu().eval()
+    fold_batchnorm(model)
+    quantized = quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8)
+    quantized.quantized = True
+    return quantized
+
+
+def compare_quantized(model, quantized, text_padded, input_lengths, seed=0):
+    """Error of quantized against model on a batch of texts.
+    Both are teacher-forced with the frames model infers, with the same PreNet
+    dropout masks, so errors do not compound over autoregressive steps.
+    Returns:
+        dict of max_abs_error and mean_abs_error of the final features over
+        valid frames, stop_agreement (fraction of frames with the same stop
+        decision), and the free-running output_lengths of both models
+    """
+    model, quantized = model.cpu().eval(), quantized.eval()
+    text_padded, input_lengths = text_padded.cpu(), input_lengths.cpu()
+    with torch.no_grad():
+        torch.manual_seed(seed)
+        feat, residual, _, _, output_lengths = model.inference(text_padded, input_lengths, return_attention=False)
+        torch.manual_seed(seed)
+        quantized_lengths = quantized.inference(text_padded, input_lengths, return_attention=False)[4]
+
+        To, Ti = feat.size(1), text_padded.size(1)
+        decoder_mask = torch.arange(To).unsqueeze(0) >= output_lengths.unsqueeze(1)
+        encoder_mask = torch.arange(Ti).unsqueeze(0) >= input_lengths.unsqueeze(1)
+        targets = feat + residual
+        outputs = []
+        for m in (model, quantized):
+            torch.manual_seed(seed)
+            outputs += [m(text_padded, input_lengths, targets, encoder_mask, decoder_mask, return_attention=False)]
+    valid = ~decoder_mask
+    (feat, residual, stop, _), (q_feat, q_residual, q_stop, _) = outputs
+    error = ((feat + residual) - (q_feat + q_residual)).abs()[valid]
+    return {
+        'max_abs_error': float(error.max()),
+        'mean_abs_error': float(error.mean()),
+        'stop_agreement': float(((stop > 0) == (q_stop > 0))[valid].float().mean()),
+        'output_lengths': output_lengths.tolist(),
+        'quantized_output_lengths': quantized_lengths.tolist(),
+    }
@@ -0,0 +1,180 @@
+"""
+TorchScript inference of FeaturePredictNet.
+
+`Decoder._step` keeps its state (LSTM states, attention context, cumulative
+attention weights, cached V*h) on module attributes, which TorchScript can not
+compile. `ScriptedFeaturePredictNet` shares the submodules (so the weights) of
+a trained FeaturePredictNet and re-implements inference with the decoder state
+passed explicitly between steps, so the whole autoregressive loop compiles.
+
+The exported artifact is a self-contained TorchScript file with the model
+config in `config.json` extra file; `load_scripted` needs no model code.
+
+Usage:
+    python export.py --model_path exp/temp/final.pth.tar --out_path exp/temp/final.ts
+    python prediction.py --model_path exp/temp/final.ts --torchscript 1 ...
+    python export.py --model_path exp/temp/final.pth.tar --out_path exp/temp/final.int8.ts --quantize 1
+"""
+import json
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+CONFIG_FILE = 'config.json'
+
+
+class ScriptedFeaturePredictNet(nn.Module):
+    """Same as FeaturePredictNet.inference, but compilable by torch.jit.script.
+
+    Args:
+        model: trained FeaturePredictNet, its submodules are shared, not copied
+    """
+
+    def __init__(self, model):
+        super(ScriptedFeaturePredictNet, self).__init__()
+        encoder, decoder = model.encoder, model.decoder
+        # Encoder
+        self.embedding = encoder.embedding
+        self.encoder_convs = encoder.convs
+        self.encoder_rnn = encoder.rnn
+        # Decoder
+        self.prenet_linear1, self.prenet_linear2 = decoder.prenet.linear1, decoder.prenet.linear2
+        self.prenet_p = decoder.prenet.p
+        self.rnn0, self.rnn1 = decoder.rnn[0], decoder.rnn[1]
+        self.attention_W, self.attention_V = decoder.attention.W, decoder.attention.V
+        self.attention_U, self.attention_F = decoder.attention.U, decoder.attention.F
+        self.attention_v = decoder.attention.v
+        self.feature_linear, self.stop_linear = decoder.feature_linear, decoder.stop_linear
+        self.postnet_convs = decoder.postnet.convs
+        self.feature_dim = decoder.feature_dim
+        self.decoder_hidden_size = decoder.decoder_hidden_size
+        self.max_decoder_steps = decoder.max_decoder_steps
+
+    def forward(self, text_padded: Tensor, input_lengths: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Args:
+            text_padded: [N, Ti]
+            input_lengths: [N]
+        Returns:
+            feat_outputs: [N, To, D], 0 after output_lengths
+            feat_residual_outputs: [N, To, D]
+            output_lengths: [N]
+        """
+        encoder_mask = torch.arange(text_padded.size(1), device=text_padded.device).unsqueeze(0) >= \
+            input_lengths.to(text_padded.device).unsqueeze(1)  # [N, Ti], True at padding
+        values = self.encode(text_padded, input_lengths, encoder_mask)
+        feat_outputs, output_lengths = self.decode(values, encoder_mask)
+        decoder_mask = torch.arange(feat_outputs.size(1), device=values.device).unsqueeze(0) >= \
+            output_lengths.unsqueeze(1)
+        feat_outputs = feat_outputs.masked_fill(decoder_mask.unsqueeze(-1), 0.0)
+        out = feat_outputs.transpose(1, 2)
+        for conv in self.postnet_convs:
+            out = conv(out).masked_fill(decoder_mask.unsqueeze(1), 0.0)
+        return feat_outputs, out.transpose(1, 2), output_lengths
+
+    def encode(self, text_padded: Tensor, input_lengths: Tensor, encoder_mask: Tensor) -> Tensor:
+        """Same as Encoder.forward, [N, Ti, He]"""
+        x = self.embedding(text_padded).transpose(1, 2)
+        for conv in self.encoder_convs:
+            x = conv(x).masked_fill(encoder_mask.unsqueeze(1), 0.0)
+        x = x.transpose(1, 2)
+        packed_input = pack_padded_sequence(x, input_lengths.cpu(), batch_first=True, enforce_sorted=False)
+        packed_output, _ = self.encoder_rnn(packed_input)
+        output, _ = pad_packed_sequence(packed_output, batch_first=True, total_length=x.size(1))
+        return output
+
+    def decode(self, values: Tensor, encoder_mask: Tensor) -> Tuple[Tensor, Tensor]:
+        """Same as Decoder.inference without PostNet
+        Returns:
+            feat_outputs: [N, To, D]
+            output_lengths: [N]
+        """
+        N, Ti = values.size(0), values.size(1)
+        h0 = values.new_zeros(N, self.decoder_hidden_size)
+        c0 = values.new_zeros(N, self.decoder_hidden_size)
+        h1 = values.new_zeros(N, self.decoder_hidden_size)
+        c1 = values.new_zeros(N, self.decoder_hidden_size)
+        cumulative_attention_weight = values.new_zeros(N, Ti)
+        attention_context = values.new_zeros(N, values.size(2))
+        Vh = self.attention_V(values)  # [N, Ti, A], independent from the step
+        output_lengths = torch.full((N,), self.max_decoder_steps, dtype=torch.long, device=values.device)
+        finished = torch.zeros(N, dtype=torch.bool, device=values.device)
+
+        capacity = min(self.max_decoder_steps, 8 * Ti)
+        feat_outputs = values.new_empty(N, capacity, self.feature_dim)
+        step_input = values.new_zeros(N, self.feature_dim)  # go frame
+        t = 0
+        while True:
+            x = self.prenet(step_input)
+            feat_output, stop_token, h0, c0, h1, c1, cumulative_attention_weight, attention_context = self.step(
+                x, h0, c0, h1, c1, cumulative_attention_weight, attention_context, values, Vh, encoder_mask)
+            if t == capacity:
+                feat_outputs = torch.cat((feat_outputs, torch.empty_like(feat_outputs)), dim=1)
+                capacity *= 2
+            feat_outputs[:, t] = feat_output
+            t += 1
+            stop = (torch.sigmoid(stop_token.squeeze(1)) > 0.5) & ~finished
+            output_lengths = output_lengths.masked_fill(stop, t)
+            finished = finished | stop
+            if bool(finished.all()) or t == self.max_decoder_steps:
+                break
+            step_input = feat_output
+        return feat_outputs[:, :t], output_lengths
+
+    def prenet(self, x: Tensor) -> Tensor:
+        # dropout is on at inference too, as in PreNet
+        x = F.dropout(F.relu(self.prenet_linear1(x)), p=self.prenet_p, training=True)
+        x = F.dropout(F.relu(self.prenet_linear2(x)), p=self.prenet_p, training=True)
+        return x
+
+    def step(self, step_input: Tensor, h0: Tensor, c0: Tensor, h1: Tensor, c1: Tensor,
+             cumulative_attention_weight: Tensor, attention_context: Tensor,
+             values: Tensor, Vh: Tensor, encoder_mask: Tensor
+             ) -> Tuple[Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor, Tensor]:
+        """Decoder._step with explicit state
+        Returns:
+            feat_output, stop_token, and the next h0, c0, h1, c1,
+            cumulative_attention_weight, attention_context
+        """
+        h0, c0 = self.rnn0(torch.cat((step_input, attention_context), dim=1), (h0, c0))
+        h1, c1 = self.rnn1(h0, (h1, c1))
+        # LocationSensitiveAttention
+        location_feature = self.attention_F(cumulative_attention_weight.unsqueeze(1))  # [N, 32, Ti]
+        Uf = self.attention_U(location_feature.transpose(1, 2))  # [N, Ti, A]
+        energies = self.attention_v(torch.tanh(self.attention_W(h1).unsqueeze(1) + Vh + Uf)).squeeze(-1)
+        energies = energies.masked_fill(encoder_mask, float('-inf'))
+        attention_weight = F.softmax(energies, dim=1)  # [N, Ti]
+        attention_context = torch.bmm(attention_weight.unsqueeze(1), values).squeeze(1)  # [N, He]
+        cumulative_attention_weight = cumulative_attention_weight + attention_weight
+        linear_input = torch.cat((h1, attention_context), dim=1)
+        feat_output = self.feature_linear(linear_input)
+        stop_token = self.stop_linear(linear_input)
+        return feat_output, stop_token, h0, c0, h1, c1, cumulative_attention_weight, attention_context
+
+
+def export_scripted(model, path):
+    """Compile model (FeaturePredictNet) for inference and save it to path"""
+    model.eval()
+    if model.decoder.attention.window_size > 0:
+        print('Warning! TorchScript model uses attention over all encoder steps, not windowed attention')
+    scripted = torch.jit.script(ScriptedFeaturePredictNet(model))
+    config = {'feature_type': model.feature_type, 'feature_dim': model.feature_dim,
+              'num_chars': model.num_chars, 'padding_idx': model.padding_idx,
+              'quantized': getattr(model, 'quantized', False)}
+    torch.jit.save(scripted, path, _extra_files={CONFIG_FILE: json.dumps(config)})
+    return scripted
+
+
+def load_scripted(path, map_location='cpu'):
+    """
+    Returns:
+        model: compiled ScriptedFeaturePredictNet, model(text_padded, input_lengths)
+        config (dict): feature_type, feature_dim, num_chars, padding_idx, quantized
+    """
+    extra_files = {CONFIG_FILE: ''}
+    model = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    return model, json.loads(extra_files[CONFIG_FILE])
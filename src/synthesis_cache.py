@@ -0,0 +1,160 @@
+"""
+Cache in front of FeaturePredictNet.inference for repeated prompts.
+
+Logic:
+- Keys are (model hash, tier, text sequence), text sequences are the output of
+  text_to_sequence, so texts differing only in what the cleaners normalize
+  share entries; the model hash (e.g. `checkpoint_hash` of the checkpoint
+  file) keeps entries of different weights apart in a shared cache_dir.
+- Utterance tier: finished features [To, D] (feat + residual, valid frames)
+  and vocoded PCM [T], in a memory LRU backed by an optional disk LRU. A hit
+  returns without running the model.
+- Encoder tier: encoder outputs [Ti, He] on the model device, in a memory
+  LRU. An utterance miss whose text was encoded before only runs the decoder.
+  Encoder rows do not depend on the other rows of the batch, so cached rows
+  are exactly what a fresh batch would compute.
+- Misses of a batch are encoded and decoded together, duplicates once.
+
+The decoder keeps PreNet dropout at inference, so an uncached prompt gives a
+slightly different utterance on every call; the cache serves the first one.
+"""
+import hashlib
+from collections import Counter
+
+import numpy as np
+import torch
+
+from utils.cache import DiskLRUCache, MemoryLRUCache
+
+TIERS = ('encoder', 'feature', 'wav')
+
+
+def checkpoint_hash(path):
+    """sha1 of the file at path"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class SynthesisCache(object):
+    """
+    Args:
+        model: FeaturePredictNet in eval mode
+        model_hash (str): identifies the weights of model, see checkpoint_hash
+        memory_bytes (int): bound of cached features and PCM in memory
+        encoder_memory_bytes (int): bound of cached encoder outputs, on the model device
+        cache_dir (str): dir of the disk tier of features and PCM, None for memory only
+        disk_bytes (int): bound of the disk tier
+
+    Usage:
+        cache = SynthesisCache(model, checkpoint_hash(model_path), cache_dir='exp/synthesis_cache')
+        features = cache.inference([text_to_sequence(text) for text in texts])
+        print(cache.stats)
+    """
+
+    def __init__(self, model, model_hash, memory_bytes=256 * 2 ** 20, encoder_memory_bytes=64 * 2 ** 20,
+                 cache_dir=None, disk_bytes=2 * 2 ** 30):
+        self.model = model
+        self.model_hash = model_hash
+        self._encoder_outputs = MemoryLRUCache(encoder_memory_bytes)
+        self._memory = MemoryLRUCache(memory_bytes)
+        self._disk = DiskLRUCache(cache_dir, disk_bytes) if cache_dir else None
+        # {tier}_hits / {tier}_misses, and disk_hits of the utterance tier
+        self.stats = Counter()
+
+    def _key(self, tier, sequence, *parts):
+        return DiskLRUCache.make_key(self.model_hash, tier, *parts, *sequence)
+
+    def _get(self, tier, key):
+        array = self._memory.get(key)
+        if array is None and self._disk is not None:
+            array = self._disk.get(key)
+            if array is not None:
+                self.stats['disk_hits'] += 1
+                self._memory.put(key, array)
+        self.stats['{}_{}'.format(tier, 'misses' if array is None else 'hits')] += 1
+        return array
+
+    def _put(self, key, array):
+        self._memory.put(key, array)
+        if self._disk is not None:
+            self._disk.put(key, array)
+
+    def inference(self, sequences):
+        """Features of a batch of text sequences, in any order of lengths.
+        Args:
+            sequences: list of list of int, see text_to_sequence
+        Returns:
+            list of [To, D] numpy float32, feat + residual outputs of the valid frames
+        """
+        keys = [self._key('feature', sequence) for sequence in sequences]
+        features = [self._get('feature', key) for key in keys]
+        misses = {}  # key -> sequence, duplicates decoded once
+        for key, sequence, feature in zip(keys, sequences, features):
+            if feature is None:
+                misses[key] = sequence
+        if misses:
+            decoded = dict(zip(misses, self._decode(list(misses.values()))))
+            for key, feature in decoded.items():
+                self._put(key, feature)
+            features = [decoded[key] if feature is None else feature for key, feature in zip(keys, features)]
+        return features
+
+    def wavs(self, sequences, vocode, vocoder='griffin_lim'):
+        """PCM of a batch of text sequences.
+        Args:
+            sequences: list of list of int, see text_to_sequence
+            vocode: callable, list of [To, D] features -> list of [T] numpy wavs
+            vocoder (str): identifies vocode and its settings in keys
+        Returns:
+            list of [T] numpy wavs
+        """
+        keys = [self._key('wav', sequence, vocoder) for sequence in sequences]
+        wavs = [self._get('wav', key) for key in keys]
+        misses = {}
+        for key, sequence, wav in zip(keys, sequences, wavs):
+            if wav is None:
+                misses[key] = sequence
+        if misses:
+            vocoded = dict(zip(misses, vocode(self.inference(list(misses.values())))))
+            for key, wav in vocoded.items():
+                self._put(key, wav)
+            wavs = [vocoded[key] if wav is None else wav for key, wav in zip(keys, wavs)]
+        return wavs
+
+    def _decode(self, sequences):
+        device = next(self.model.parameters()).device
+        encoder_outputs = self._encode(sequences, device)
+        input_lengths = torch.LongTensor([len(sequence) for sequence in sequences]).to(device)
+        encoder_padded_outputs = torch.nn.utils.rnn.pad_sequence(encoder_outputs, batch_first=True)
+        encoder_mask = torch.arange(encoder_padded_outputs.size(1), device=device).unsqueeze(0) >= \
+            input_lengths.unsqueeze(1)  # [N, Ti], True at padding
+        with torch.no_grad():
+            outputs = self.model.decoder.inference(encoder_padded_outputs, encoder_mask, return_attention=False)
+        feat_outputs, feat_residual_outputs, _, _, output_lengths = outputs
+        feat_pred = (feat_outputs + feat_residual_outputs).cpu().numpy().astype(np.float32)
+        # copy, so a cached feature does not keep the whole batch alive
+        return [feat_pred[i, :length].copy() for i, length in enumerate(output_lengths.tolist())]
+
+    def _encode(self, sequences, device):
+        """Returns list of [Ti, He] encoder outputs, encoding the missing ones as one batch"""
+        keys = [self._key('encoder', sequence) for sequence in sequences]
+        outputs = [self._encoder_outputs.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        self.stats['encoder_hits'] += len(sequences) - len(missing)
+        self.stats['encoder_misses'] += len(missing)
+        if missing:
+            input_lengths = torch.LongTensor([len(sequences[i]) for i in missing])
+            text_padded = torch.full((len(missing), int(input_lengths.max())), self.model.padding_idx,
+                                     dtype=torch.long)
+            for row, i in enumerate(missing):
+                text_padded[row, :len(sequences[i])] = torch.LongTensor(sequences[i])
+            with torch.no_grad():
+                encoder_padded_outputs = self.model.encoder(text_padded.to(device), input_lengths.to(device))
+            for row, i in enumerate(missing):
+                # clone, so a cached row does not keep the whole batch alive
+                outputs[i] = encoder_padded_outputs[row, :input_lengths[row]].clone()
+                self._encoder_outputs.put(keys[i], outputs[i])
+        return outputs
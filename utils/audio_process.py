@@ -1,53 +1,106 @@
+import os
+
 import librosa 
 import librosa.filters 
 import numpy as np 
-from scipy import signal 
+from scipy import signal, sparse
 from scipy.io import wavfile 
 import hyperparams as hparams
 
-def load_wav(path, sr):
-    return librosa.core.load(path, sr=sr)[0]
+def load_wav(path, sr, cache=None):
+    """Decode and resample path to sr. With cache (utils.cache.DiskLRUCache), the
+    float32 PCM is stored by (path, mtime, sr), so repeated loads only read a file.
+    """
+    if cache is None:
+        return librosa.core.load(path, sr=sr)[0]
+    key = cache.make_key(os.path.abspath(path), os.stat(path).st_mtime_ns, sr)
+    wav = cache.get(key)
+    if wav is None:
+        wav = librosa.core.load(path, sr=sr)[0].astype(np.float32)
+        cache.put(key, wav)
+    return wav
 
 def save_wav(wav, path):
-    # 32767
-    wav *= 32767 / max(0.01, np.max(np.abs(wav)))
+    # 32767, scale a copy, the caller may still use wav
+    wav = wav * (32767 / max(0.01, np.max(np.abs(wav))))
     wavfile.write(path, hparams.sample_rate, wav.astype(np.int16))
 
 def spectrogram(y):
-    D = _stft(_preemphasis(y))
+    D = _stft(_preemphasis(_as_float(y)))
     S = _amp_to_db(np.abs(D)) - hparams.ref_level_db
     return _normalize(S)
 
 
 def inv_spectrogram(spectrogram):
-    S = _db_to_amp(_denormalize(spectrogram) + hparams.ref_level_db)  # Convert back to linear
+    S = _db_to_amp(_denormalize(_as_float(spectrogram)) + hparams.ref_level_db)  # Convert back to linear
     return _inv_preemphasis(_griffin_lim(S ** hparams.power))  # Reconstruct phase
 
 
 def melspectrogram(y):
-    D = _stft(_preemphasis(y))
+    D = _stft(_preemphasis(_as_float(y)))
     S = _amp_to_db(_linear_to_mel(np.abs(D)))
     return _normalize(S)
 
 
 def inv_melspectrogram(melspectrogram):
-    S = _mel_to_linear(_db_to_amp(_denormalize(melspectrogram)))  # Convert back to linear
+    S = _mel_to_linear(_db_to_amp(_denormalize(_as_float(melspectrogram))))  # Convert back to linear
     return _inv_preemphasis(_griffin_lim(S ** 1.5))  # Reconstruct phase
 
 
+FEATURE_TYPES = ('linear', 'mel')
+
+
+def get_feature_extractor(feature_type):
+    """spectrogram for 'linear', melspectrogram for 'mel' features"""
+    _check_feature_type(feature_type)
+    return melspectrogram if feature_type == 'mel' else spectrogram
+
+
+def get_feature_inverter(feature_type):
+    """inv_spectrogram for 'linear', inv_melspectrogram for 'mel' features"""
+    _check_feature_type(feature_type)
+    return inv_melspectrogram if feature_type == 'mel' else inv_spectrogram
+
+
+def get_feature_dim(feature_type):
+    """Number of bins of a frame of feature_type"""
+    _check_feature_type(feature_type)
+    return hparams.num_mels if feature_type == 'mel' else hparams.feature_dim
+
+
+def _check_feature_type(feature_type):
+    if feature_type not in FEATURE_TYPES:
+        raise ValueError("feature_type should be one of {}, but got "
+                         "feature_type={}".format(FEATURE_TYPES, feature_type))
+
+
+# Precision:
+# hparams.audio_dtype 'float32' keeps every step in float32/complex64 (librosa
+# follows the input dtype), 'float64' is the double precision path.
+
+def _as_float(x):
+    return np.asarray(x, dtype=hparams.audio_dtype)
+
+
+def _complex_dtype():
+    return np.result_type(hparams.audio_dtype, np.complex64)
+
+
 # Based on https://github.com/librosa/librosa/issues/434
 def _griffin_lim(S):
-    angles = np.exp(2j * np.pi * np.random.rand(*S.shape))
-    S_complex = np.abs(S).astype(np.complex)
+    complex_dtype = _complex_dtype()
+    angles = np.exp(2j * np.pi * np.random.rand(*S.shape)).astype(complex_dtype)
+    S_complex = np.abs(S).astype(complex_dtype)
     for i in range(hparams.griffin_lim_iters):
         if i > 0:
-            angles = np.exp(1j * np.angle(_stft(y)))
+            angles = np.exp(1j * np.angle(_stft(y))).astype(complex_dtype)
         y = _istft(S_complex * angles)
     return y
 
 
 def _stft(y):
-    return librosa.stft(y=y, n_fft=hparams.fft_size, hop_length=get_hop_size())
+    # reflect, as utils/torch_audio.py pads; librosa >= 0.10 defaults to 'constant'
+    return librosa.stft(y=y, n_fft=hparams.fft_size, hop_length=get_hop_size(), pad_mode='reflect')
 
 
 def _istft(y):
@@ -56,29 +109,76 @@ def _istft(y):
 
 # Conversions:
 
-_mel_basis = None
-_inv_mel_basis = None
+class MelFilterbank(object):
+    """Mel filterbank of one audio config, a sparse copy of it for products with
+    spectrograms (each filter covers a few bins) and its pseudo-inverse.
+    """
+
+    def __init__(self, basis, inv_basis):
+        self.basis = basis  # [num_mels, 1 + fft_size // 2]
+        self.sparse_basis = sparse.csr_matrix(basis)
+        self.inv_basis = inv_basis  # [1 + fft_size // 2, num_mels]
+
+
+# (sample_rate, fft_size, num_mels, fmin, fmax) -> MelFilterbank
+_filterbanks = {}
+
+
+def get_mel_filterbank(sample_rate=None, fft_size=None, num_mels=None, fmin=None, fmax=None):
+    """MelFilterbank of the given config, None takes the current hparams value.
+    Filterbanks are cached per config in this process and, if
+    hparams.filterbank_cache_dir is set, on disk, so the pinv is computed once.
+    """
+    key = (hparams.sample_rate if sample_rate is None else sample_rate,
+           hparams.fft_size if fft_size is None else fft_size,
+           hparams.num_mels if num_mels is None else num_mels,
+           hparams.min_freq if fmin is None else fmin,
+           hparams.max_freq if fmax is None else fmax)
+    filterbank = _filterbanks.get(key)
+    if filterbank is None:
+        filterbank = _filterbanks[key] = _load_or_build_filterbank(*key)
+    return filterbank
+
+
+def _load_or_build_filterbank(sample_rate, fft_size, num_mels, fmin, fmax):
+    path = None
+    if hparams.filterbank_cache_dir:
+        # librosa version is in the name, its mel filters changed across versions
+        path = os.path.join(os.path.expanduser(hparams.filterbank_cache_dir),
+                            'mel_{}_{}_{}_{}_{}_librosa{}.npz'.format(
+                                sample_rate, fft_size, num_mels, fmin, fmax, librosa.__version__))
+        try:
+            with np.load(path) as cached:
+                return MelFilterbank(cached['basis'], cached['inv_basis'])
+        except (OSError, ValueError, KeyError):  # not cached yet or corrupted
+            pass
+    basis = _build_mel_basis(sample_rate, fft_size, num_mels, fmin, fmax)
+    filterbank = MelFilterbank(basis, np.linalg.pinv(basis))
+    if path is not None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.{}.tmp.npz'.format(path[:-len('.npz')], os.getpid())
+            np.savez(tmp_path, basis=filterbank.basis, inv_basis=filterbank.inv_basis)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print('Warning! Can not cache mel filterbank to {}: {}'.format(path, e))
+    return filterbank
 
 
 def _linear_to_mel(spectrogram):
-    global _mel_basis
-    if _mel_basis is None:
-        _mel_basis = _build_mel_basis()
-    return np.dot(_mel_basis, spectrogram)
+    return get_mel_filterbank().sparse_basis.dot(spectrogram)
 
 
 def _mel_to_linear(mel_spectrogram):
-    global _inv_mel_basis
-    if _inv_mel_basis is None:
-        _inv_mel_basis = np.linalg.pinv(_build_mel_basis())
-    # return np.maximum(1e-10, np.dot(_inv_mel_basis, mel_spectrogram))
-    return np.maximum(hparams.floor_freq, np.dot(_inv_mel_basis, mel_spectrogram))
+    inv_basis = get_mel_filterbank().inv_basis
+    # return np.maximum(1e-10, np.dot(inv_basis, mel_spectrogram))
+    return np.maximum(hparams.floor_freq, np.dot(inv_basis, mel_spectrogram))
 
 
-def _build_mel_basis():
+def _build_mel_basis(sample_rate, fft_size, num_mels, fmin, fmax):
     # n_fft = (hparams.num_freq - 1) * 2
     # return librosa.filters.mel(hparams.sample_rate, n_fft, n_mels=hparams.num_mels)
-    return librosa.filters.mel(hparams.sample_rate, n_fft=hparams.fft_size, n_mels=hparams.num_mels, fmin=hparams.min_freq, fmax=hparams.max_freq)
+    return librosa.filters.mel(sr=sample_rate, n_fft=fft_size, n_mels=num_mels, fmin=fmin, fmax=fmax)
 
 
 def _amp_to_db(x):
@@ -90,11 +190,12 @@ def _db_to_amp(x):
 
 
 def _preemphasis(x):
-    return signal.lfilter([1, -hparams.preemphasis], [1], x)
+    # coefficients in x's dtype, lfilter would run in float64 otherwise
+    return signal.lfilter(np.array([1, -hparams.preemphasis], dtype=x.dtype), np.ones(1, dtype=x.dtype), x)
 
 
 def _inv_preemphasis(x):
-    return signal.lfilter([1], [1, -hparams.preemphasis], x)
+    return signal.lfilter(np.ones(1, dtype=x.dtype), np.array([1, -hparams.preemphasis], dtype=x.dtype), x)
 
 
 def _normalize(S):
@@ -116,3 +217,26 @@ def get_hop_size():
         assert hparams.frame_shift_ms is not None
         hop_size = int(hparams.frame_shift_ms / 1000 * hparams.sample_rate)
     return hop_size
+
+
+if __name__ == '__main__':
+    # Tolerance of the float32 path against the float64 one, run from the repo root:
+    # python -m utils.audio_process
+    t = np.arange(3 * hparams.sample_rate) / hparams.sample_rate
+    y = 0.5 * np.sin(2 * np.pi * 200 * (1 + t) * t) + 0.01 * np.random.RandomState(0).randn(len(t))
+    outputs = {}
+    for audio_dtype in ('float64', 'float32'):
+        hparams.audio_dtype = audio_dtype
+        np.random.seed(0)  # same initial Griffin-Lim phases
+        spec, mel = spectrogram(y), melspectrogram(y)
+        outputs[audio_dtype] = spec, mel, inv_spectrogram(spec), inv_melspectrogram(mel)
+    names = ['spectrogram', 'melspectrogram', 'inv_spectrogram', 'inv_melspectrogram']
+    # features are normalized to [-4, 4]; wavs are compared relative to their peak
+    tolerances = [5e-3, 5e-3, 1e-2, 1e-2]
+    for name, tolerance, x64, x32 in zip(names, tolerances, *outputs.values()):
+        assert x32.dtype == np.float32, (name, x32.dtype)
+        error = np.max(np.abs(x64 - x32))
+        if name.startswith('inv'):
+            error /= np.max(np.abs(x64))
+        print('{}: max error {:.2e}'.format(name, error))
+        assert error < tolerance, (name, error)
@@ -0,0 +1,139 @@
+"""
+Asynchronous output stage of batch synthesis.
+
+Logic:
+- The main thread keeps decoding and hands finished spectrograms (or already
+  vocoded waveforms) to `AsyncAudioWriter`, which vocodes and encodes them
+  into WAV files in a pool of worker processes.
+- `submit_vocode` runs a batched vocoder (e.g. torch Griffin-Lim on the model
+  device) in one background thread instead, torch ops release the GIL, so it
+  overlaps decoding too; its waveforms then go to the pool as `submit_wav`.
+- At most `max_pending` items are in flight: `submit` blocks when the pool is
+  behind, so a fast decoder can not pile up spectrograms in memory.
+- Output names are given by the caller (e.g. the line number of the text),
+  so files do not depend on completion order; each file is written to a
+  temporary name and renamed, so a file that exists is complete.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from utils.audio_process import get_feature_inverter, save_wav
+
+
+def _write(path, wav=None, feature=None, feature_type='linear'):
+    if wav is None:
+        wav = get_feature_inverter(feature_type)(feature)
+    tmp_path = '{}.{}.tmp.wav'.format(path[:-len('.wav')], os.getpid())
+    save_wav(wav, tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+class AsyncAudioWriter(object):
+    """
+    Args:
+        out_dir (str): dir of output {name}.wav files
+        num_workers (int): number of vocoding/encoding processes
+        max_pending (int): max items submitted but not written yet, and max
+            batches submitted to submit_vocode but not vocoded yet
+        feature_type (str): 'linear' or 'mel', how `submit` vocodes features
+
+    Usage:
+        with AsyncAudioWriter(out_dir) as writer:
+            for i, text in enumerate(texts):
+                writer.submit(str(i), feature)  # [D, T] numpy
+        # all files are written here
+    """
+
+    def __init__(self, out_dir, num_workers=2, max_pending=8, feature_type='linear'):
+        if max_pending < 1:
+            raise ValueError("max_pending should be >= 1, but got "
+                             "max_pending={}".format(max_pending))
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.feature_type = feature_type
+        self._executor = ProcessPoolExecutor(num_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._vocoder = ThreadPoolExecutor(1)  # one thread, batches are vocoded in order
+        self._vocode_slots = threading.BoundedSemaphore(max_pending)
+        self._futures = set()
+        self._errors = []
+        self._lock = threading.Lock()
+
+    def submit(self, name, feature):
+        """Vocode feature [D, T] (numpy, normalized) and write it to {out_dir}/{name}.wav.
+        Blocks while max_pending items are in flight.
+        Returns:
+            path of the wav file, written later
+        """
+        return self._submit(name, feature=feature, feature_type=self.feature_type)
+
+    def submit_wav(self, name, wav):
+        """Write an already vocoded wav [T] (numpy) to {out_dir}/{name}.wav, see submit"""
+        return self._submit(name, wav=wav)
+
+    def submit_vocode(self, names, vocode, *args):
+        """Run vocode(*args) in the vocoder thread, then write its i-th wav
+        (numpy [T]) to {out_dir}/{names[i]}.wav. Blocks while max_pending
+        batches are waiting for the vocoder thread.
+        Returns:
+            paths of the wav files, written later
+        """
+        self._raise_error()
+        self._vocode_slots.acquire()
+        try:
+            future = self._vocoder.submit(self._vocode, names, vocode, *args)
+        except BaseException:
+            self._vocode_slots.release()
+            raise
+        future.add_done_callback(self._vocode_done)
+        return [os.path.join(self.out_dir, '{}.wav'.format(name)) for name in names]
+
+    def _vocode(self, names, vocode, *args):
+        for name, wav in zip(names, vocode(*args)):
+            self.submit_wav(name, wav)
+
+    def _vocode_done(self, future):
+        if future.exception() is not None:
+            with self._lock:
+                self._errors += [future.exception()]
+        self._vocode_slots.release()
+
+    def _submit(self, name, **kwargs):
+        self._raise_error()
+        path = os.path.join(self.out_dir, '{}.wav'.format(name))
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(_write, path, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        return path
+
+    def _done(self, future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception() is not None:
+                self._errors += [future.exception()]
+        self._slots.release()
+
+    def _raise_error(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def close(self):
+        """Wait for every submitted item, then raise the first error if any"""
+        self._vocoder.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,129 @@
+"""
+Size-bounded LRU caches of arrays, on disk (DiskLRUCache) and in memory (MemoryLRUCache).
+
+Logic:
+- DiskLRUCache: one .npy file per key, written to a temporary name and renamed, so several
+  processes (e.g. DataLoader workers) can share a cache directory.
+- Recency is the file mtime, touched on every hit; when the total size goes
+  over max_bytes, the least recently used files are removed. A process only
+  counts its own writes, so it re-scans the directory every max_bytes / 20
+  bytes it writes, to see the writes of the others: N processes overshoot
+  max_bytes by at most N * max_bytes / 20.
+- MemoryLRUCache: arrays in an OrderedDict in recency order, the least
+  recently used ones are dropped as soon as the total goes over max_bytes.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class DiskLRUCache(object):
+    """
+    Args:
+        cache_dir (str): directory of cached files
+        max_bytes (int): bound of the total size of cached files
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._size = None  # scanned lazily, then counts the writes of this process
+        self._unscanned = 0  # bytes written by this process since the last scan
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1('|'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """Returns the cached array of key, or None"""
+        path = self._path(key)
+        try:
+            array = np.load(path)
+            os.utime(path)  # mark as recently used
+        except (OSError, ValueError):  # missing, evicted meanwhile or corrupted
+            return None
+        return array
+
+    def put(self, key, array):
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+            size = f.tell()  # not stat after replace, another process may evict it by then
+        os.replace(tmp_path, path)
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += size
+            self._unscanned += size
+        if self._size > self.max_bytes or self._unscanned > self.max_bytes / 20:
+            self._evict()
+
+    def _entries(self):
+        """Yields (mtime, size, path) of cached files"""
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield stat.st_mtime_ns, stat.st_size, entry.path
+
+    def _evict(self):
+        # Re-scan, other processes write to the same directory. If over the
+        # bound, evict down to 90% of it, so we do not rescan on every put.
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        self._unscanned = 0
+        if total <= self.max_bytes:
+            self._size = total
+            return
+        for _, size, path in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # removed by another process
+                pass
+            total -= size
+        self._size = total
+
+
+class MemoryLRUCache(object):
+    """Size-bounded in-memory LRU cache of arrays (numpy or torch, sized by .nbytes)
+
+    Args:
+        max_bytes (int): bound of the total size of cached arrays
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._arrays = OrderedDict()
+
+    def __len__(self):
+        return len(self._arrays)
+
+    def get(self, key):
+        """Returns the cached array of key, or None"""
+        array = self._arrays.get(key)
+        if array is not None:
+            self._arrays.move_to_end(key)  # mark as recently used
+        return array
+
+    def put(self, key, array):
+        if array.nbytes > self.max_bytes:  # would evict everything, and itself
+            return
+        if key in self._arrays:
+            self.size -= self._arrays.pop(key).nbytes
+        self._arrays[key] = array
+        self.size += array.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self._arrays.popitem(last=False)
+            self.size -= evicted.nbytes
@@ -7,7 +7,7 @@ Logic:
 """
 import csv
 
-import librosa
+import numpy as np
 import pandas as pd
 import torch
 import torch.utils.data as data
@@ -15,27 +15,108 @@ from torch._six import int_classes as _int_classes
 from torch.utils.data import Dataset
 from torch.utils.data.sampler import SequentialSampler
 
-from utils.audio_process import load_wav
+from utils.audio_process import get_hop_size, load_wav
+from utils.duration_index import build_duration_index
+
+
+def read_metadata(csv_file):
+    """Read a LJSpeech style csv, wav|text|norm_text, into a DataFrame with wav and norm_text"""
+    metadata = pd.read_csv(f'{csv_file}', sep='|',
+                           names=['wav', 'text', 'norm_text'],
+                           usecols=['wav', 'norm_text'],
+                           quoting=csv.QUOTE_NONE)  # not ignore quote in string
+    metadata.dropna(inplace=True)  # Actually, nothing to drop
+    return metadata
+
+
+def _pack(sequences, dtype):
+    """Pack sequences into one flat array and offsets, sequence i is flat[offsets[i]:offsets[i+1]]"""
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in sequences])
+    flat = np.fromiter((x for sequence in sequences for x in sequence), dtype=dtype, count=offsets[-1])
+    return flat, offsets
 
 
 class LJSpeechDataset(data.Dataset):
-    
+    """
+    Metadata is kept in a few numpy arrays but not Python objects (e.g. a
+    DataFrame), so looking up an item is O(1) and does not touch refcounts,
+    i.e. DataLoader workers do not copy the forked pages of metadata.
+    - texts: pre-tokenized ids (utf-8 bytes without text_transformer) in one flat array + offsets
+    - wav ids: one fixed-width bytes array
+    """
+
     def __init__(self, wav_path, csv_file='data/metadata.csv',
                  text_transformer=None, audio_transformer=None,
-                 sample_rate=22050, sort=True):
+                 sample_rate=22050, sort=True, feature_store=None, index_file=None, wav_cache=None):
         self.wav_path = wav_path
-        self.metadata = pd.read_csv(f'{csv_file}', sep='|',
-                                    names=['wav', 'text', 'norm_text'],
-                                    usecols=['wav', 'norm_text'],
-                                    quoting=csv.QUOTE_NONE)  # not ignore quote in string
-        self.metadata.dropna(inplace=True)  # Actually, nothing to drop
+        metadata = read_metadata(csv_file)
         self.text_transformer = text_transformer
         self.audio_transformer = audio_transformer
         self.sample_rate = sample_rate
+        # Precomputed features, see utils/feature_store.py. If given, audio is never decoded.
+        self.feature_store = feature_store
+        self.index_file = index_file
+        # Resampled audio cache, see utils/cache.py
+        self.wav_cache = wav_cache
+
+        wav_ids, texts = metadata['wav'].tolist(), metadata['norm_text'].tolist()
+        del metadata
+        self.wav_ids = np.array([wav_id.encode('utf-8') for wav_id in wav_ids])  # dtype S
+        if self.text_transformer:
+            sequences = [self.text_transformer(text) for text in texts]
+            max_id = max((max(x) for x in sequences if len(x) > 0), default=0)
+            self.text_data, self.text_offsets = _pack(sequences, np.int16 if max_id < 2**15 else np.int32)
+        else:
+            self.text_data, self.text_offsets = _pack([text.encode('utf-8') for text in texts], np.uint8)
+        self.frames = None
         if sort:
-            self.metadata['length'] = self.metadata['wav'].apply(
-                    lambda x: librosa.get_duration(filename=f'{wav_path}/wavs/{x}.wav'))
-            self.metadata.sort_values(by=['length'], inplace=True, ascending=False)
+            self.frames = self._get_frames(texts)
+            order = np.argsort(-self.frames, kind='stable')
+            self._reorder(order)
+        self._set_store_rows()
+
+    def _reorder(self, order):
+        lengths = np.diff(self.text_offsets)[order]
+        starts = self.text_offsets[:-1][order]
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        # position in old text_data of each element of the reordered text_data
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        self.text_data, self.text_offsets = self.text_data[positions], offsets
+        self.wav_ids = self.wav_ids[order]
+        self.frames = self.frames[order]
+
+    def _set_store_rows(self):
+        # dataset index -> row of feature_store, so __getitem__ does not hash wav ids
+        self.store_rows = None
+        if self.feature_store is not None:
+            self.store_rows = np.array([self.feature_store.get_row(wav_id)
+                                        for wav_id in self.get_wav_ids()], dtype=np.int64)
+
+    def _get_frames(self, texts=None):
+        """Number of feature frames of each item, without decoding audio."""
+        if self.feature_store is not None:
+            return np.array([self.feature_store.get_length(wav_id)
+                             for wav_id in self.get_wav_ids()], dtype=np.int64)
+        # Read from wav headers, and cached in index_file, see utils/duration_index.py
+        index = build_duration_index(self.wav_path, self.get_wav_ids(), texts, index_file=self.index_file)
+        # Length after resampling to sample_rate, then STFT frames with center=True
+        samples = np.ceil(index.frames * self.sample_rate / index.sample_rates)
+        return (1 + samples // get_hop_size()).astype(np.int64)
+
+    def get_wav_ids(self):
+        return [wav_id.decode('utf-8') for wav_id in self.wav_ids]
+
+    def get_lengths(self):
+        """
+        Returns:
+            frames (np.ndarray): number of feature frames of each item, [len(self)]
+            text_lengths (np.ndarray): length of each text, [len(self)]
+        """
+        if self.frames is None:
+            self.frames = self._get_frames()
+        return self.frames, np.diff(self.text_offsets)
 
     def __getitem__(self, index):
         """
@@ -49,18 +130,19 @@ class LJSpeechDataset(data.Dataset):
         return text, audio
 
     def __len__(self):
-        return len(self.metadata)
+        return len(self.wav_ids)
 
     def _get_text(self, index):
-        text = self.metadata.iloc[index]['norm_text']
+        text = self.text_data[self.text_offsets[index]:self.text_offsets[index+1]]
         if self.text_transformer:
-            text = self.text_transformer(text)
-            text = torch.IntTensor(text)
-        return text
+            return torch.from_numpy(text.astype(np.int32))
+        return text.tobytes().decode('utf-8')
 
     def _get_audio(self, index):
-        filename = self.metadata.iloc[index]['wav']
-        audio = load_wav(f'{self.wav_path}/wavs/{filename}.wav', self.sample_rate)
+        if self.feature_store is not None:
+            return self.feature_store.get(self.store_rows[index])
+        filename = self.wav_ids[index].decode('utf-8')
+        audio = load_wav(f'{self.wav_path}/wavs/{filename}.wav', self.sample_rate, cache=self.wav_cache)
         if self.audio_transformer:
             audio = self.audio_transformer(audio)
         return torch.FloatTensor(audio)
@@ -109,12 +191,184 @@ class RandomBucketBatchSampler(object):
         return len(self.random_batches)
 
 
+class FrameBudgetBatchSampler(object):
+    """Yields mini-batches of indices whose padded size fits in a budget.
+
+    Each epoch, lengths are jittered by a random factor and sorted, so similar
+    lengths are still neighbours (buckets) while the contents of buckets change
+    between epochs. Then batches are packed greedily until batch_size * max_length
+    would exceed max_frames, or the padding ratio would exceed max_padding_ratio,
+    and the order of batches is shuffled. All randomness comes from seed and epoch.
+    Args:
+        lengths (list): length of each item, e.g. frames or tokens, see LJSpeechDataset.get_lengths
+        max_frames (int): max total of padded frames (tokens) in a mini-batch
+        max_padding_ratio (float): max ratio of padding frames in a mini-batch
+        max_batch_size (int): max number of items in a mini-batch, None means no limit
+        length_noise (float): relative range of the length jitter, 0 keeps the batches fixed
+        seed (int): random seed, the RNG of epoch e is seeded with seed + e
+        drop_last (bool): If ``True``, the sampler will drop the last packed batch,
+            which usually holds the leftover shortest items
+    """
+
+    def __init__(self, lengths, max_frames, max_padding_ratio=0.2, max_batch_size=None,
+                 length_noise=0.1, seed=0, drop_last=False):
+        if not isinstance(max_frames, _int_classes) or isinstance(max_frames, bool) or \
+                max_frames <= 0:
+            raise ValueError("max_frames should be a positive integeral value, "
+                             "but got max_frames={}".format(max_frames))
+        if not 0 <= max_padding_ratio < 1:
+            raise ValueError("max_padding_ratio should be in [0, 1), but got "
+                             "max_padding_ratio={}".format(max_padding_ratio))
+        if not isinstance(drop_last, bool):
+            raise ValueError("drop_last should be a boolean value, but got "
+                             "drop_last={}".format(drop_last))
+        self.lengths = torch.tensor(np.asarray(lengths, dtype=np.float64))
+        self.max_frames = max_frames
+        self.max_padding_ratio = max_padding_ratio
+        self.max_batch_size = max_batch_size
+        self.length_noise = length_noise
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches_epoch, self._batches = None, None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _make_batches(self):
+        if self._batches_epoch == self.epoch:
+            return self._batches
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        noise = 1 + self.length_noise * (2 * torch.rand(len(self.lengths), generator=g) - 1)
+        indices = torch.argsort(self.lengths * noise, descending=True).tolist()
+        lengths = self.lengths.tolist()
+
+        batches, batch, max_length, total = [], [], 0, 0
+        for i in indices:
+            length = lengths[i]
+            n, new_max_length = len(batch) + 1, max(max_length, length)
+            padded = n * new_max_length
+            if batch and (padded > self.max_frames or
+                          padded - total - length > self.max_padding_ratio * padded or
+                          (self.max_batch_size and n > self.max_batch_size)):
+                batches += [batch]
+                batch, new_max_length, total = [], length, 0
+            batch += [i]
+            max_length, total = new_max_length, total + length
+        if batch and not self.drop_last:
+            batches += [batch]
+
+        random_indices = torch.randperm(len(batches), generator=g).tolist()
+        self._batches_epoch = self.epoch
+        self._batches = [batches[i] for i in random_indices]
+        return self._batches
+
+    def __iter__(self):
+        batches = self._make_batches()
+        self.epoch += 1  # reshuffle next time, unless set_epoch is called
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        return len(self._make_batches())
+
+
+class DistributedBucketBatchSampler(object):
+    """Shards the mini-batches of a bucket batch sampler across processes.
+
+    Every rank builds the same batches, shuffles them with the shared seed and
+    takes every num_replicas-th one, so ranks get disjoint batches of similar
+    size. The batch list is padded by repeating batches (or truncated if drop_last)
+    so that every rank runs the same number of steps and never waits on a
+    gradient all-reduce that other ranks will not do.
+    Args:
+        batch_sampler: RandomBucketBatchSampler or FrameBudgetBatchSampler,
+            built from the same dataset (and seed) on every rank
+        num_replicas (int): number of processes, default is the world size
+        rank (int): rank of current process, default is the global rank
+        seed (int): random seed shared by all ranks
+        drop_last (bool): If ``True``, drop tail batches instead of padding
+    """
+
+    def __init__(self, batch_sampler, num_replicas=None, rank=None, seed=0, drop_last=False):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        if not 0 <= rank < num_replicas:
+            raise ValueError("rank should be in [0, {}), but got "
+                             "rank={}".format(num_replicas, rank))
+        self.batch_sampler = batch_sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(epoch)
+
+    def _make_batches(self):
+        if hasattr(self.batch_sampler, 'set_epoch'):
+            self.batch_sampler.set_epoch(self.epoch)
+        # batches are disjoint, so sorting makes the order independent of the rank's RNG
+        batches = sorted(self.batch_sampler, key=min)
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        if self.drop_last:
+            batches = batches[:len(batches) - len(batches) % self.num_replicas]
+        elif batches:
+            padding_size = -len(batches) % self.num_replicas
+            batches += (batches * (padding_size // len(batches) + 1))[:padding_size]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        batches = self._make_batches()
+        self.epoch += 1  # reshuffle next time, unless set_epoch is called
+        for batch in batches:
+            yield batch
+
+    def __len__(self):
+        return len(self._make_batches())
+
+
 class TextAudioCollate(object):
     """Another way to implement collate_fn passed to DataLoader.
     Use class but not function because this is easier to pass some parameters.
+
+    Masks and stop tokens are built with one broadcast comparison, and padded
+    tensors can be reused across batches to avoid allocating (and page faulting)
+    a new [N, D, To] tensor for each batch.
+    Args:
+        n_frames_per_step (int): pad the number of frames to a multiple of it
+        reuse_buffers (bool): If ``True``, padded tensors are views of buffers
+            kept across batches. Only safe with num_workers=0 and when a batch is
+            consumed (e.g. copied to GPU) before the next one is collated.
+        pin_memory (bool): If ``True``, allocate padded tensors in pinned memory
     """
-    def __init__(self, n_frames_per_step=1):
+    def __init__(self, n_frames_per_step=1, reuse_buffers=False, pin_memory=False):
         self.n_frames_per_step = n_frames_per_step
+        self.reuse_buffers = reuse_buffers
+        self.pin_memory = pin_memory
+        self._buffers = {}
+
+    def _zeros(self, name, size, dtype):
+        if not self.reuse_buffers:
+            tensor = torch.zeros(size, dtype=dtype)
+            return tensor.pin_memory() if self.pin_memory else tensor
+        numel = int(np.prod(size))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.numel() < numel:
+            # grow geometrically, so buffers are reallocated only a few times
+            capacity = max(numel, 2 * buffer.numel() if buffer is not None else 0)
+            buffer = torch.empty(capacity, dtype=dtype)
+            buffer = buffer.pin_memory() if self.pin_memory else buffer
+            self._buffers[name] = buffer
+        return buffer[:numel].view(size).zero_()
 
     def __call__(self, batch):
         """Process one mini-batch samples, such as sorting and padding.
@@ -125,55 +379,87 @@ class TextAudioCollate(object):
             input_lengths: [N]
             mel_padded: [N, To, D]
             gate_padded: [N, To]
-            output_lengths: [N]
+            encoder_mask: [N, Ti], True at padding positions
+            decoder_mask: [N, To], True at padding positions
         """
-        # Right zero-pad all one-hot text sequences to max input length
+        N = len(batch)
         input_lengths, ids_sorted_decreasing = torch.sort(
             torch.LongTensor([len(x[0]) for x in batch]),
             dim=0, descending=True)
-        max_input_len = input_lengths[0]
+        ids_sorted_decreasing = ids_sorted_decreasing.tolist()
+        output_lengths = torch.LongTensor([batch[i][1].size(1) for i in ids_sorted_decreasing])
 
-        text_padded = torch.LongTensor(len(batch), max_input_len)
-        text_padded.zero_()
-        for i in range(len(ids_sorted_decreasing)):
-            text = batch[ids_sorted_decreasing[i]][0]
-            text_padded[i, :text.size(0)]= text
+        # Right zero-pad all one-hot text sequences to max input length
+        max_input_len = input_lengths[0].item()
+        encoder_mask = get_mask_from_lengths(input_lengths, max_input_len)
+        text_padded = self._zeros('text', (N, max_input_len), torch.long)
+        text_padded[~encoder_mask] = torch.cat([batch[i][0] for i in ids_sorted_decreasing]).long()
 
         # Right zero-pad mel-spec
         num_mels = batch[0][1].size(0)
-        max_target_len = max([x[1].size(1) for x in batch])
+        max_target_len = output_lengths.max().item()
         if max_target_len % self.n_frames_per_step != 0:
             max_target_len += self.n_frames_per_step - max_target_len % self.n_frames_per_step
             assert max_target_len % self.n_frames_per_step == 0
+        decoder_mask = get_mask_from_lengths(output_lengths, max_target_len)
 
-        # include mel padded and gate padded
-        mel_padded = torch.FloatTensor(len(batch), num_mels, max_target_len)
-        mel_padded.zero_()
-        gate_padded = torch.FloatTensor(len(batch), max_target_len)
-        gate_padded.zero_()
-        output_lengths = torch.LongTensor(len(batch))
-        for i in range(len(ids_sorted_decreasing)):
-            mel = batch[ids_sorted_decreasing[i]][1]
+        # include mel padded and gate padded. Items are copied in their [D, T] layout:
+        # this copy is memory bound, gathering them into one bulk copy is slower.
+        mel_padded = self._zeros('mel', (N, num_mels, max_target_len), torch.float)
+        for i, j in enumerate(ids_sorted_decreasing):
+            mel = batch[j][1]
             mel_padded[i, :, :mel.size(1)] = mel
-            gate_padded[i, mel.size(1)-1:] = 1
-            output_lengths[i] = mel.size(1)
         mel_padded = mel_padded.transpose(1, 2)  # [N, To, D]
-
-        # Generate mask
-        encoder_mask = get_mask_from_lengths(input_lengths)
-        decoder_mask = get_mask_from_lengths(output_lengths)
+        gate_padded = self._zeros('gate', (N, max_target_len), torch.float)
+        gate_padded.masked_fill_(get_mask_from_lengths(output_lengths - 1, max_target_len), 1)
 
         return text_padded, input_lengths, mel_padded, gate_padded, encoder_mask, decoder_mask
 
 
-def get_mask_from_lengths(lengths):
-    """Mask position is set to 1 for Tensor.masked_fill(mask, value)"""
-    N = lengths.size(0)
-    T = torch.max(lengths).item()
-    mask = torch.zeros(N, T)
-    for i in range(N):
-        mask[i, lengths[i]:] = 1
-    return mask.byte()
+class TextWavCollate(object):
+    """collate_fn for items of raw waveforms (LJSpeechDataset without audio_transformer).
+    Features are extracted later, batched on the training device, see
+    utils.torch_audio.BatchFeatureExtractor.
+    """
+    def __call__(self, batch):
+        """
+        Args:
+            batch: a list of (text sequence, waveform)
+        Returns:
+            text_padded: [N, Ti]
+            input_lengths: [N]
+            wav_padded: [N, T]
+            wav_lengths: [N]
+        """
+        N = len(batch)
+        input_lengths, ids_sorted_decreasing = torch.sort(
+            torch.LongTensor([len(x[0]) for x in batch]),
+            dim=0, descending=True)
+        ids_sorted_decreasing = ids_sorted_decreasing.tolist()
+
+        text_padded = torch.zeros(N, input_lengths[0].item(), dtype=torch.long)
+        text_padded[~get_mask_from_lengths(input_lengths)] = \
+            torch.cat([batch[i][0] for i in ids_sorted_decreasing]).long()
+
+        wav_lengths = torch.LongTensor([batch[i][1].size(0) for i in ids_sorted_decreasing])
+        wav_padded = torch.zeros(N, wav_lengths.max().item())
+        for i, j in enumerate(ids_sorted_decreasing):
+            wav_padded[i, :wav_lengths[i]] = batch[j][1]
+        return text_padded, input_lengths, wav_padded, wav_lengths
+
+
+def get_mask_from_lengths(lengths, max_len=None):
+    """Mask position is set to True for Tensor.masked_fill(mask, value)
+    Args:
+        lengths: [N]
+        max_len (int): size of time-axis, default is max(lengths)
+    Returns:
+        mask (torch.BoolTensor): [N, max_len]
+    """
+    if max_len is None:
+        max_len = torch.max(lengths).item()
+    ids = torch.arange(max_len, device=lengths.device)
+    return ids.unsqueeze(0) >= lengths.unsqueeze(1)
 
 
 if __name__ == '__main__':
@@ -204,6 +490,12 @@ if __name__ == '__main__':
     # [[9], [6, 7, 8], [0, 1, 2], [3, 4, 5]]
     # [[3, 4, 5], [0, 1, 2], [6, 7, 8], [9]]
 
+    # Test FrameBudgetBatchSampler
+    lengths = [100, 90, 90, 80, 50, 45, 40, 20, 10, 10]
+    sampler = FrameBudgetBatchSampler(lengths, max_frames=200, seed=123)
+    print(list(sampler))
+    print(list(sampler))  # reshuffled
+
     # Test DataLoader
     from torch.utils.data import DataLoader
     from audio_process import spectrogram
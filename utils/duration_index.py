@@ -0,0 +1,110 @@
+"""
+Persistent duration index of a corpus.
+
+Logic:
+- Sorting a dataset by length only needs the number of samples of each wav,
+  which is in the wav header, so we never decode audio here.
+- The index is saved as npz and is validated against file mtimes (and text
+  digests, a 64 bit sha1 prefix per text, so the index does not grow with the
+  texts), so later runs only rescan the wavs which changed.
+- Headers are read with a process pool, which matters on network storage.
+"""
+import hashlib
+import os
+import zipfile
+from multiprocessing import Pool
+
+import numpy as np
+import soundfile
+
+
+class DurationIndex(object):
+    """Frame counts and sample rates of wavs, aligned with `ids`."""
+
+    FIELDS = ['ids', 'text_digests', 'mtimes', 'frames', 'sample_rates']
+
+    def __init__(self, ids, text_digests, mtimes, frames, sample_rates):
+        self.ids = np.asarray(ids, dtype=str)
+        self.text_digests = np.asarray(text_digests, dtype=np.int64)
+        self.mtimes = np.asarray(mtimes, dtype=np.int64)
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.sample_rates = np.asarray(sample_rates, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as index:
+            return cls(*[index[name] for name in cls.FIELDS])
+
+    def save(self, path):
+        # per process, ranks of a distributed run may save the same index
+        tmp_path = '{}.{}.tmp.npz'.format(path, os.getpid())
+        np.savez(tmp_path, **{name: getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp_path, path)
+
+
+def text_digests(texts):
+    """int64 digest of each text, the first 8 bytes of its sha1"""
+    return np.array([int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:8], 'little', signed=True)
+                     for text in texts], dtype=np.int64)
+
+
+def _read_header(path):
+    info = soundfile.info(path)
+    return info.frames, info.samplerate
+
+
+def build_duration_index(wav_path, wav_ids, texts, index_file=None, num_workers=None):
+    """Load index_file and rescan the entries which are missing or stale.
+
+    Args:
+        wav_path (str): dir including wavs/{wav_id}.wav
+        wav_ids (list): wav ids, e.g. metadata['wav']
+        texts (list): texts of wav_ids, e.g. metadata['norm_text'], None means texts are not checked
+        index_file (str): where to load and save the index, None means in memory only
+        num_workers (int): number of processes to read headers, None means cpu count
+    Returns:
+        DurationIndex aligned with wav_ids
+    """
+    wav_ids = list(wav_ids)
+    texts = list(texts) if texts is not None else [''] * len(wav_ids)
+    paths = [f'{wav_path}/wavs/{wav_id}.wav' for wav_id in wav_ids]
+    mtimes = np.array([os.stat(path).st_mtime_ns for path in paths], dtype=np.int64)
+    frames = np.zeros(len(wav_ids), dtype=np.int64)
+    sample_rates = np.zeros(len(wav_ids), dtype=np.int64)
+    stale = np.ones(len(wav_ids), dtype=bool)
+    digests = text_digests(texts)
+
+    old = None
+    if index_file and os.path.exists(index_file):
+        try:
+            old = DurationIndex.load(index_file)
+        except (KeyError, ValueError, EOFError, OSError, zipfile.BadZipFile) as e:  # older format or corrupt
+            print('Warning! Rebuilding duration index {}: {!r}'.format(index_file, e))
+    if old is not None:
+        old_rows = {wav_id: i for i, wav_id in enumerate(old.ids.tolist())}
+        rows = np.array([old_rows.get(wav_id, -1) for wav_id in wav_ids], dtype=np.int64)
+        found = rows >= 0
+        stale[found] = (old.mtimes[rows[found]] != mtimes[found]) | \
+                       (old.text_digests[rows[found]] != digests[found])
+        fresh = ~stale
+        frames[fresh] = old.frames[rows[fresh]]
+        sample_rates[fresh] = old.sample_rates[rows[fresh]]
+
+    stale_rows = np.nonzero(stale)[0]
+    if len(stale_rows) > 0:
+        print('Scanning {}/{} wav headers'.format(len(stale_rows), len(wav_ids)), flush=True)
+        with Pool(num_workers) as pool:
+            headers = pool.map(_read_header, [paths[i] for i in stale_rows], chunksize=64)
+        for i, (n_frames, sample_rate) in zip(stale_rows, headers):
+            frames[i], sample_rates[i] = n_frames, sample_rate
+
+    index = DurationIndex(wav_ids, digests, mtimes, frames, sample_rates)
+    if index_file and len(stale_rows) > 0:
+        try:
+            index.save(index_file)
+        except OSError as e:
+            print('Warning! Could not save duration index {}: {}'.format(index_file, e))
+    return index
@@ -0,0 +1,144 @@
+"""
+Memory-mapped spectrogram store.
+
+Logic:
+- `write_feature_store` runs the audio transformer (e.g. `spectrogram`) once
+  over the whole corpus and appends every feature matrix to one contiguous
+  binary file, frame-major, i.e. [T, D] per utterance.
+- `index.npz` keeps wav id -> (offset, length) in frames plus the dtype and
+  the feature type, so a store is not read as features of another type.
+- `FeatureStore` memory-maps the binary file and returns [D, T] views of it,
+  so reading an item does not decode audio nor copy data (float32 storage).
+"""
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+
+from utils.audio_process import load_wav
+
+FEATURES_FILE = 'features.bin'
+INDEX_FILE = 'index.npz'
+
+
+class FeatureStore(object):
+    """Read-only view of a feature store written by `write_feature_store`.
+
+    Args:
+        store_dir (str): directory including features.bin and index.npz
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index = np.load(os.path.join(store_dir, INDEX_FILE))
+        self.ids = index['ids']
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.feature_dim = int(index['feature_dim'])
+        self.dtype = np.dtype(str(index['dtype']))
+        # '' if unknown, e.g. stores written before the feature type was recorded
+        self.feature_type = str(index['feature_type']) if 'feature_type' in index.files else ''
+        self._rows = {wav_id: i for i, wav_id in enumerate(self.ids.tolist())}
+        self._data = None  # opened lazily, once per (worker) process
+
+    def __getstate__(self):
+        # Do not pickle the mapping into DataLoader workers, re-open it there.
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    @property
+    def data(self):
+        if self._data is None:
+            total_frames = int(self.offsets[-1] + self.lengths[-1]) if len(self.ids) else 0
+            # mode 'c' is copy-on-write: writable for torch, but never touches the file
+            self._data = np.memmap(os.path.join(self.store_dir, FEATURES_FILE),
+                                   dtype=self.dtype, mode='c',
+                                   shape=(total_frames, self.feature_dim))
+        return self._data
+
+    def __contains__(self, wav_id):
+        return wav_id in self._rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, wav_id):
+        """
+        Returns:
+            feature (torch.FloatTensor): [D, T], a view of the mapping if stored as float32
+        """
+        return self.get(self._rows[wav_id])
+
+    def get_row(self, wav_id):
+        return self._rows[wav_id]
+
+    def get(self, row):
+        """Same as __getitem__, but by row of the index, see get_row"""
+        offset, length = self.offsets[row], self.lengths[row]
+        feature = torch.from_numpy(self.data[offset:offset+length]).t()
+        if feature.dtype != torch.float32:
+            feature = feature.float()
+        return feature
+
+    def get_length(self, wav_id):
+        """Number of frames of wav_id"""
+        return int(self.lengths[self._rows[wav_id]])
+
+
+def _extract_feature(args):
+    path, sample_rate, audio_transformer = args
+    return audio_transformer(load_wav(path, sample_rate))
+
+
+def write_feature_store(store_dir, wav_path, wav_ids, audio_transformer,
+                        sample_rate=22050, dtype='float32', num_workers=1, feature_type=None):
+    """Extract features of every wav_ids[i] and write them into store_dir.
+
+    Args:
+        store_dir (str): output directory
+        wav_path (str): dir including wavs/{wav_id}.wav
+        wav_ids (list): wav ids, e.g. metadata['wav']
+        audio_transformer: function mapping raw audio to a [D, T] feature
+        dtype (str): storage type, 'float32' or 'float16'
+        num_workers (int): number of processes to extract features
+        feature_type (str): 'linear' or 'mel', what audio_transformer extracts
+    Returns:
+        FeatureStore
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float16):
+        raise ValueError("dtype should be float32 or float16, but got "
+                         "dtype={}".format(dtype))
+    os.makedirs(store_dir, exist_ok=True)
+    features_path = os.path.join(store_dir, FEATURES_FILE)
+    index_path = os.path.join(store_dir, INDEX_FILE)
+    # Remove a stale index first, so an interrupted run never looks complete.
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    jobs = [(f'{wav_path}/wavs/{wav_id}.wav', sample_rate, audio_transformer)
+            for wav_id in wav_ids]
+    offsets, lengths = [], []
+    offset, feature_dim = 0, None
+    with open(features_path, 'wb') as f, Pool(num_workers) as pool:
+        for feature in pool.imap(_extract_feature, jobs, chunksize=8):
+            if feature_dim is None:
+                feature_dim = feature.shape[0]
+            assert feature.shape[0] == feature_dim
+            np.ascontiguousarray(feature.T, dtype=dtype).tofile(f)  # [T, D]
+            offsets += [offset]
+            lengths += [feature.shape[1]]
+            offset += feature.shape[1]
+            if len(lengths) % 1000 == 0:
+                print('Extracted {}/{}'.format(len(lengths), len(jobs)), flush=True)
+
+    tmp_path = index_path + '.tmp.npz'
+    np.savez(tmp_path, ids=np.array(list(wav_ids), dtype=str),
+             offsets=np.array(offsets, dtype=np.int64),
+             lengths=np.array(lengths, dtype=np.int64),
+             feature_dim=np.int64(feature_dim or 0), dtype=dtype.name,
+             feature_type=feature_type or '')
+    os.replace(tmp_path, index_path)
+    return FeatureStore(store_dir)
@@ -0,0 +1,206 @@
+"""
+Sharded dataset format for sequential reads.
+
+Logic:
+- `write_shards` packs (text ids, audio or features) records into a few large
+  shard files, written and read strictly sequentially, plus one `index.npz`.
+- A record is int32 text ids followed by audio samples [T] or feature frames
+  [T, D] in the store dtype.
+- `ShardedDataset` is an IterableDataset: each DataLoader worker streams its
+  own shards (shard order reshuffled per epoch) through a shuffle buffer.
+"""
+import itertools
+import os
+import random
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from utils.audio_process import load_wav
+
+INDEX_FILE = 'index.npz'
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def _shard_name(shard):
+    return 'shard-%05d.bin' % shard
+
+
+def _load_item(args):
+    path, sample_rate, audio_transformer = args
+    audio = load_wav(path, sample_rate)
+    if audio_transformer:
+        audio = audio_transformer(audio).T  # [D, T] -> [T, D]
+    return audio
+
+
+def write_shards(shard_dir, wav_path, wav_ids, texts, text_transformer, audio_transformer=None,
+                 sample_rate=22050, shard_size=256, dtype='float32', num_workers=1):
+    """Pack a corpus into shard files.
+
+    Args:
+        shard_dir (str): output directory
+        wav_path (str): dir including wavs/{wav_id}.wav
+        wav_ids (list): wav ids, e.g. metadata['wav']
+        texts (list): texts of wav_ids, e.g. metadata['norm_text']
+        text_transformer: function mapping text to an id sequence
+        audio_transformer: function mapping raw audio to a [D, T] feature,
+            None means storing raw audio
+        shard_size (int): approximate size of a shard in MB
+        dtype (str): storage type of audio or features, 'float32' or 'float16'
+        num_workers (int): number of processes to load audio
+    Returns:
+        number of shards
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float16):
+        raise ValueError("dtype should be float32 or float16, but got "
+                         "dtype={}".format(dtype))
+    os.makedirs(shard_dir, exist_ok=True)
+    index_path = os.path.join(shard_dir, INDEX_FILE)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    jobs = [(f'{wav_path}/wavs/{wav_id}.wav', sample_rate, audio_transformer)
+            for wav_id in wav_ids]
+    shards, offsets, text_lengths, audio_lengths = [], [], [], []
+    shard, offset, feature_dim = 0, 0, None
+    f = open(os.path.join(shard_dir, _shard_name(shard)), 'wb')
+    try:
+        with Pool(num_workers) as pool:
+            for text, audio in zip(texts, pool.imap(_load_item, jobs, chunksize=8)):
+                if offset >= shard_size * 1024 * 1024:
+                    f.close()
+                    shard, offset = shard + 1, 0
+                    f = open(os.path.join(shard_dir, _shard_name(shard)), 'wb')
+                text = np.asarray(text_transformer(text), dtype=np.int32)
+                audio = np.ascontiguousarray(audio, dtype=dtype)
+                if feature_dim is None:
+                    feature_dim = audio.shape[1] if audio.ndim == 2 else 0
+                f.write(text.tobytes())
+                f.write(audio.tobytes())
+                shards += [shard]
+                offsets += [offset]
+                text_lengths += [len(text)]
+                audio_lengths += [audio.shape[0]]
+                offset += text.nbytes + audio.nbytes
+                if len(shards) % 1000 == 0:
+                    print('Packed {}/{}'.format(len(shards), len(jobs)), flush=True)
+    finally:
+        f.close()
+
+    tmp_path = index_path + '.tmp.npz'
+    np.savez(tmp_path, shards=np.array(shards, dtype=np.int32),
+             offsets=np.array(offsets, dtype=np.int64),
+             text_lengths=np.array(text_lengths, dtype=np.int64),
+             audio_lengths=np.array(audio_lengths, dtype=np.int64),
+             num_shards=np.int64(shard + 1), feature_dim=np.int64(feature_dim or 0),
+             dtype=dtype.name)
+    os.replace(tmp_path, index_path)
+    return shard + 1
+
+
+class ShardedDataset(data.IterableDataset):
+    """Streams the records of shards written by `write_shards`.
+
+    Shards are split between distributed ranks, then between the DataLoader
+    workers of a rank, so use at least as many shards as ranks * workers.
+    Every rank yields the same number of records from each of its workers
+    (the smallest among ranks, the others drop their last records), so ranks
+    run the same number of steps and DistributedDataParallel does not hang.
+    Items are the same as LJSpeechDataset's.
+    Args:
+        shard_dir (str): dir including index.npz and shard files
+        shuffle_buffer (int): number of records to shuffle among, 0 means no shuffle
+        seed (int): random seed, shard order and shuffling are seeded with seed + epoch
+        num_replicas (int): number of ranks, default is the torch.distributed world size if initialized, else 1
+        rank (int): rank of this process, default is the torch.distributed rank if initialized, else 0
+    """
+
+    def __init__(self, shard_dir, shuffle_buffer=1024, seed=0, num_replicas=None, rank=None):
+        self.shard_dir = shard_dir
+        index = np.load(os.path.join(shard_dir, INDEX_FILE))
+        self.shards = index['shards']
+        self.offsets = index['offsets']
+        self.text_lengths = index['text_lengths']
+        self.audio_lengths = index['audio_lengths']
+        self.num_shards = int(index['num_shards'])
+        self.feature_dim = int(index['feature_dim'])
+        self.dtype = np.dtype(str(index['dtype']))
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if distributed else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if not 0 <= rank < num_replicas:
+            raise ValueError("rank should be in [0, num_replicas), but got "
+                             "rank={}, num_replicas={}".format(rank, num_replicas))
+        self.num_replicas, self.rank = num_replicas, rank
+        if self.num_shards < num_replicas:
+            print('Warning! {} shards for {} ranks, ranks read the same shards'.format(self.num_shards, num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.shards)
+
+    def _read_shard(self, shard):
+        """Yields records of shard, reading the file sequentially"""
+        rows = np.nonzero(self.shards == shard)[0]
+        frame_size = max(self.feature_dim, 1)
+        with open(os.path.join(self.shard_dir, _shard_name(shard)), 'rb',
+                  buffering=READ_BUFFER_SIZE) as f:
+            for row in rows:
+                text_length, audio_length = int(self.text_lengths[row]), int(self.audio_lengths[row])
+                text = np.frombuffer(f.read(4 * text_length), dtype=np.int32)
+                audio = np.frombuffer(f.read(self.dtype.itemsize * audio_length * frame_size),
+                                      dtype=self.dtype)
+                text = torch.from_numpy(text.copy())
+                audio = torch.from_numpy(audio.astype(np.float32))
+                if self.feature_dim > 0:
+                    audio = audio.view(audio_length, self.feature_dim).t()  # [D, T]
+                yield text, audio
+
+    def __iter__(self):
+        worker_info = data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+        # Same shard order in every rank and worker, padded by repeating shards
+        # so every rank gets as many, then each rank and worker takes its own shards
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_shards, generator=g).tolist()
+        padded = -(-len(order) // self.num_replicas) * self.num_replicas
+        order = [order[i % len(order)] for i in range(padded)]
+        records = np.bincount(self.shards, minlength=self.num_shards)
+        # records of this worker index in every rank, each rank yields the smallest
+        quota = min(int(records[order[rank::self.num_replicas][worker_id::num_workers]].sum())
+                    for rank in range(self.num_replicas))
+        shards = order[self.rank::self.num_replicas][worker_id::num_workers]
+        rng = random.Random(self.seed + (self.epoch * self.num_replicas + self.rank) * num_workers + worker_id)
+        self.epoch += 1  # reshuffle next time, unless set_epoch is called
+
+        for item in itertools.islice(self._shuffled(shards, rng), quota):
+            yield item
+
+    def _shuffled(self, shards, rng):
+        """Yields records of shards through the shuffle buffer"""
+        buffer = []
+        for shard in shards:
+            for item in self._read_shard(shard):
+                if len(buffer) < self.shuffle_buffer:
+                    buffer += [item]
+                elif self.shuffle_buffer > 0:
+                    i = rng.randrange(len(buffer))
+                    yield buffer[i]
+                    buffer[i] = item
+                else:
+                    yield item
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield item
@@ -6,14 +6,16 @@ import torch
 
 class Solver(object):
     
-    def __init__(self, data_loader, model, criterion, optimizer, args):
+    def __init__(self, data_loader, model, criterion, optimizer, args, batch_transform=None):
         self.data_loader = data_loader
+        self.batch_transform = batch_transform
         self.model = model
         self.criterion = criterion
         self.optimizer = optimizer
 
         # Training config
         self.use_cuda = args.use_cuda
+        self.rank = getattr(args, 'rank', 0)  # only rank 0 saves models in distributed training
         self.epochs = args.epochs
         self.max_norm = args.max_norm
         # save and load model
@@ -46,10 +48,7 @@ class Solver(object):
         if self.continue_from:
             print('Loading checkpoint model %s' % self.continue_from)
             package = torch.load(self.continue_from)
-            if self.use_cuda:
-                self.model.module.load_state_dict(package['state_dict'])
-            else:
-                self.model.load_state_dict(package['state_dict'])
+            self._unwrap_model().load_state_dict(package['state_dict'])
             self.optimizer.load_state_dict(package['optim_dict'])
             self.start_epoch = int(package.get('epoch', 1))
             self.tr_loss[:self.start_epoch] = package['tr_loss'][:self.start_epoch]
@@ -59,12 +58,22 @@ class Solver(object):
         # Create save folder
         os.makedirs(self.save_folder, exist_ok=True)
 
+    def _unwrap_model(self):
+        # (Distributed)DataParallel keeps the model in .module
+        return self.model.module if hasattr(self.model, 'module') else self.model
+
     def train(self):
         # Train model multi-epoches
         for epoch in range(self.start_epoch, self.epochs):
             # Train one epoch
             print("Training...")
             self.model.train()  # Turn on BatchNorm & Dropout
+            batch_sampler = getattr(self.data_loader, 'batch_sampler', None)
+            if hasattr(batch_sampler, 'set_epoch'):
+                batch_sampler.set_epoch(epoch)  # reshuffle batches per epoch
+            dataset = getattr(self.data_loader, 'dataset', None)
+            if hasattr(dataset, 'set_epoch'):
+                dataset.set_epoch(epoch)  # reshuffle shards per epoch
             start = time.time()
 
             tr_avg_loss = self._run_one_epoch(epoch)
@@ -78,19 +87,19 @@ class Solver(object):
             # Save model each epoch
             self.tr_loss[epoch] = tr_avg_loss
             self.cv_loss[epoch] = tr_avg_loss  # Fake
-            if self.checkpoint:
+            if self.rank == 0 and self.checkpoint:
                 file_path = os.path.join(
                     self.save_folder, 'epoch%d.pth.tar' % (epoch + 1))
-                model = self.model
+                model = self._unwrap_model()
                 torch.save(model.serialize(model,
                                            self.optimizer, epoch + 1,
                                            tr_loss=self.tr_loss,
                                            cv_loss=self.cv_loss),
                            file_path)
                 print('Saving checkpoint model to %s' % file_path)
-            else:
+            elif self.rank == 0:
                 # Save the last model
-                model =  self.model
+                model = self._unwrap_model()
                 file_path = os.path.join(self.save_folder, self.model_path)
                 torch.save(model.serialize(model,
                                            self.optimizer, epoch + 1,
@@ -127,13 +136,11 @@ class Solver(object):
 
         for i, (data) in enumerate(data_loader):
             self.step += 1
+            if self.use_cuda:
+                data = [x.cuda() for x in data]
+            if self.batch_transform is not None:
+                data = self.batch_transform(*data)  # e.g. extract features on the device
             text_padded, input_lengths, feat_padded, stop_token_padded, encoder_mask, decoder_mask = data
-            text_padded = text_padded.cuda()
-            input_lengths = input_lengths.cuda()
-            feat_padded = feat_padded.cuda()
-            stop_token_padded = stop_token_padded.cuda()
-            encoder_mask = encoder_mask.cuda()
-            decoder_mask = decoder_mask.cuda()
             print("I am just after decoder mask, right one before self.model")
             y_pred = self.model(text_padded, input_lengths, feat_padded, encoder_mask, decoder_mask)
             y_target = (feat_padded, stop_token_padded)
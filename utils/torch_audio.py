@@ -0,0 +1,385 @@
+"""
+Torch implementation of utils/audio_process.py for batches.
+
+Logic:
+- Works on a padded batch of waveforms [N, T] plus their lengths, on any device,
+  so DataLoader workers only decode audio and FFTs are batched.
+- Every utterance is reflect-padded at its own end, as librosa.stft(center=True)
+  does, so the valid frames match `audio_process.spectrogram` of each utterance.
+- The inverse overlap-adds only valid frames, so batched Griffin-Lim of
+  variable-length spectrograms is the same as vocoding them one by one.
+- `StreamingInvSpectrogram` vocodes frames as they arrive, see its docstring.
+"""
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import signal
+
+import hyperparams as hparams
+from utils.audio_process import _check_feature_type, get_hop_size, get_mel_filterbank
+from utils.data import get_mask_from_lengths
+
+
+def spectrogram(wavs, lengths):
+    """
+    Args:
+        wavs: [N, T], padded waveforms
+        lengths: [N], number of samples of each waveform
+    Returns:
+        S: [N, D, To], padding frames are 0
+        frame_lengths: [N]
+    """
+    D, frame_lengths = _stft(_preemphasis(wavs), lengths)
+    S = _amp_to_db(D.abs()) - hparams.ref_level_db
+    S = _normalize(S)
+    mask = get_mask_from_lengths(frame_lengths, S.size(-1))
+    return S.masked_fill(mask.unsqueeze(1), 0.0), frame_lengths
+
+
+def melspectrogram(wavs, lengths):
+    """Same as spectrogram, but of audio_process.melspectrogram"""
+    D, frame_lengths = _stft(_preemphasis(wavs), lengths)
+    S = _amp_to_db(_linear_to_mel(D.abs()))
+    S = _normalize(S)
+    mask = get_mask_from_lengths(frame_lengths, S.size(-1))
+    return S.masked_fill(mask.unsqueeze(1), 0.0), frame_lengths
+
+
+def inv_spectrogram(spectrogram, lengths=None, feature_type='linear'):
+    """Batched audio_process.inv_spectrogram, or inv_melspectrogram if feature_type is 'mel'
+    Args:
+        spectrogram: [N, D, T], normalized spectrograms, e.g. decoder outputs transposed
+        lengths: [N], number of valid frames of each spectrogram, None means all T
+    Returns:
+        wavs: [N, hop_size * (T - 1)], padding samples are 0
+        wav_lengths: [N]
+    """
+    if lengths is None:
+        lengths = torch.full((spectrogram.size(0),), spectrogram.size(-1), dtype=torch.long)
+    lengths = lengths.to(spectrogram.device)
+    S = _to_magnitude(spectrogram, feature_type)
+    wavs, wav_lengths = _griffin_lim(S, lengths)  # Reconstruct phase
+    wavs = _inv_preemphasis(wavs)
+    mask = get_mask_from_lengths(wav_lengths, wavs.size(-1))
+    return wavs.masked_fill(mask, 0.0), wav_lengths
+
+
+def inv_melspectrogram(melspectrogram, lengths=None):
+    """Batched audio_process.inv_melspectrogram, see inv_spectrogram"""
+    return inv_spectrogram(melspectrogram, lengths, feature_type='mel')
+
+
+def _to_magnitude(spectrogram, feature_type):
+    """Normalized features [N, D, T] -> linear magnitudes ** power [N, F, T] for Griffin-Lim"""
+    _check_feature_type(feature_type)
+    if feature_type == 'mel':
+        S = _mel_to_linear(_db_to_amp(_denormalize(spectrogram)))
+    else:
+        S = _db_to_amp(_denormalize(spectrogram) + hparams.ref_level_db)
+    return S ** hparams.power
+
+
+def _griffin_lim(S, lengths, n_iters=None, momentum=None, angles=None):
+    """Fast Griffin-Lim (Perraudin et al., 2013) of a batch, momentum=0 is the
+    plain algorithm of audio_process._griffin_lim.
+    Args:
+        S: [N, F, T], magnitudes
+        lengths: [N], number of valid frames, later frames are ignored
+        angles: [N, F, T], initial phases as unit complex numbers, default is random
+    Returns:
+        y: [N, hop_size * (T - 1)]
+        wav_lengths: [N]
+    """
+    n_iters = hparams.torch_griffin_lim_iters if n_iters is None else n_iters
+    momentum = hparams.griffin_lim_momentum if momentum is None else momentum
+    alpha = momentum / (1 + momentum)
+    valid = ~get_mask_from_lengths(lengths, S.size(-1))
+    S = S * valid.unsqueeze(1)
+    envelope = _window_envelope(valid)
+    if angles is None:
+        angles = torch.exp(2j * math.pi * torch.rand(S.shape, device=S.device))
+    y, wav_lengths = _istft(S * angles, valid, envelope)
+    tprev = None
+    for i in range(1, n_iters):
+        rebuilt, _ = _stft(y, wav_lengths)
+        angles = rebuilt - alpha * tprev if tprev is not None else rebuilt
+        angles = angles / (angles.abs() + 1e-16)
+        tprev = rebuilt
+        y, _ = _istft(S * angles, valid, envelope)
+    return y, wav_lengths
+
+
+def _window_envelope(valid):
+    """Sum of squared windows of valid frames, [N, n_fft + hop_size * (T - 1)]"""
+    n_fft, hop_size = hparams.fft_size, get_hop_size()
+    window = torch.hann_window(n_fft, periodic=True, device=valid.device)
+    frames = (window ** 2).view(1, n_fft, 1) * valid.unsqueeze(1).float()  # [N, n_fft, T]
+    length = n_fft + hop_size * (valid.size(1) - 1)
+    return F.fold(frames, (1, length), (1, n_fft), stride=(1, hop_size)).view(valid.size(0), length)
+
+
+def _istft(D, valid, envelope=None):
+    """librosa.istft(D, hop_length, center=True) of each utterance, overlap-adding
+    only valid frames, so padding frames do not change the window normalization.
+    Args:
+        D: [N, n_fft // 2 + 1, T], complex
+        valid: [N, T], True at valid frames
+        envelope: _window_envelope(valid), to reuse it between calls
+    Returns:
+        y: [N, hop_size * (T - 1)]
+        wav_lengths: [N]
+    """
+    n_fft, hop_size = hparams.fft_size, get_hop_size()
+    N, T = valid.size()
+    if envelope is None:
+        envelope = _window_envelope(valid)
+    window = torch.hann_window(n_fft, periodic=True, device=D.device)
+    frames = torch.fft.irfft(D, n=n_fft, dim=1) * window.view(1, n_fft, 1)  # [N, n_fft, T]
+    frames = frames * valid.unsqueeze(1)
+    length = n_fft + hop_size * (T - 1)
+    y = F.fold(frames, (1, length), (1, n_fft), stride=(1, hop_size)).view(N, length)
+    y = torch.where(envelope > 1e-11, y / envelope.clamp(min=1e-11), y)
+    y = y[:, n_fft // 2:length - n_fft // 2]  # remove center padding
+    return y, hop_size * (valid.sum(1) - 1)
+
+
+def _preemphasis(x):
+    """Same as signal.lfilter([1, -preemphasis], [1], x) along the last axis"""
+    return torch.cat((x[..., :1], x[..., 1:] - hparams.preemphasis * x[..., :-1]), dim=-1)
+
+
+def _stft(y, lengths):
+    """librosa.stft(y, n_fft, hop_length, center=True, pad_mode='reflect') of each utterance
+    Args:
+        y: [N, T]
+        lengths: [N]
+    Returns:
+        D: [N, n_fft // 2 + 1, To], complex
+        frame_lengths: [N]
+    """
+    n_fft, hop_size = hparams.fft_size, get_hop_size()
+    pad = n_fft // 2
+    frame_lengths = 1 + lengths // hop_size
+    # Reflect each row at its own boundaries: position p reads y[|p|] or y[2(L-1)-p]
+    positions = torch.arange(-pad, y.size(1) + pad, device=y.device).abs().unsqueeze(0)
+    last = (lengths - 1).unsqueeze(1).to(y.device)
+    positions = torch.where(positions > last, 2 * last - positions, positions).clamp(min=0)
+    y = torch.gather(y, 1, positions.expand(y.size(0), -1))
+    window = torch.hann_window(n_fft, periodic=True, dtype=y.dtype, device=y.device)
+    D = torch.stft(y, n_fft, hop_length=hop_size, window=window, center=False,
+                   return_complex=True)
+    return D[..., :int(frame_lengths.max())], frame_lengths
+
+
+def _denormalize(D):
+    return (((torch.clamp(D, -hparams.max_abs_value,
+                          hparams.max_abs_value) + hparams.max_abs_value) * -hparams.min_level_db / (
+                     2 * hparams.max_abs_value))
+            + hparams.min_level_db)
+
+
+def _amp_to_db(x):
+    return 20 * torch.log10(torch.clamp(x, min=1e-5))
+
+
+def _inv_preemphasis(x):
+    """Same as signal.lfilter([1], [1, -preemphasis], x) along the last axis.
+    The recursion runs in scipy, torch has no IIR filter.
+    """
+    y = signal.lfilter([1], [1, -hparams.preemphasis], x.detach().cpu().numpy(), axis=-1)
+    return torch.from_numpy(y).to(device=x.device, dtype=x.dtype)
+
+
+def _linear_to_mel(S):
+    basis = torch.from_numpy(get_mel_filterbank().basis).to(S.device, S.dtype)
+    return torch.matmul(basis, S)
+
+
+def _mel_to_linear(M):
+    inv_basis = torch.from_numpy(get_mel_filterbank().inv_basis).to(M.device, M.dtype)
+    return torch.clamp(torch.matmul(inv_basis, M), min=hparams.floor_freq)
+
+
+def _db_to_amp(x):
+    return torch.pow(10.0, x * 0.05)
+
+
+def _normalize(S):
+    return torch.clamp(
+        (2 * hparams.max_abs_value) * ((S - hparams.min_level_db) / (-hparams.min_level_db)) - hparams.max_abs_value,
+        -hparams.max_abs_value, hparams.max_abs_value)
+
+
+class BatchFeatureExtractor(object):
+    """Turns a batch of TextWavCollate into a batch of TextAudioCollate, on the
+    device of the batch. Pass it to Solver as batch_transform.
+
+    Args:
+        feature_type (str): 'linear' for spectrogram, 'mel' for melspectrogram
+    """
+
+    def __init__(self, feature_type='linear'):
+        _check_feature_type(feature_type)
+        self.extract = melspectrogram if feature_type == 'mel' else spectrogram
+
+    def __call__(self, text_padded, input_lengths, wav_padded, wav_lengths):
+        """
+        Returns:
+            text_padded: [N, Ti]
+            input_lengths: [N]
+            feat_padded: [N, To, D]
+            gate_padded: [N, To]
+            encoder_mask: [N, Ti]
+            decoder_mask: [N, To]
+        """
+        with torch.no_grad():
+            feat_padded, output_lengths = self.extract(wav_padded, wav_lengths)
+        feat_padded = feat_padded.transpose(1, 2)  # [N, To, D]
+        max_target_len = feat_padded.size(1)
+        output_lengths = output_lengths.to(feat_padded.device)
+        gate_padded = get_mask_from_lengths(output_lengths - 1, max_target_len).float()
+        encoder_mask = get_mask_from_lengths(input_lengths)
+        decoder_mask = get_mask_from_lengths(output_lengths, max_target_len)
+        return text_padded, input_lengths, feat_padded, gate_padded, encoder_mask, decoder_mask
+
+
+class StreamingInvSpectrogram(object):
+    """inv_spectrogram of one utterance whose frames arrive over time, e.g. from
+    the decoder, returning PCM as soon as enough frames are known.
+
+    Every chunk of `chunk_frames` frames is reconstructed by Griffin-Lim on a
+    window with `context_frames` already emitted frames before it and
+    `lookahead_frames` after it. The window starts from the phases of the
+    previous window where they overlap, and the first `overlap_frames` of a
+    chunk are cross-faded with the held back end of the previous chunk, so
+    chunk boundaries do not click. `_inv_preemphasis` keeps its filter state
+    between chunks, so the emitted chunks concatenate into one waveform of the
+    same length as inv_spectrogram of all frames.
+
+    The first audio is available after chunk_frames + lookahead_frames frames.
+
+    Usage:
+        vocoder = StreamingInvSpectrogram()
+        for frames in ...:  # [T, D], normalized, e.g. decoder outputs
+            play(vocoder.push(frames))
+        play(vocoder.flush())
+
+    Set feature_type to 'mel' to vocode mel spectrogram frames.
+    """
+
+    def __init__(self, chunk_frames=32, context_frames=8, lookahead_frames=4, overlap_frames=2,
+                 n_iters=None, momentum=None, feature_type='linear'):
+        _check_feature_type(feature_type)
+        n_fft, hop_size = hparams.fft_size, get_hop_size()
+        if overlap_frames * hop_size + n_fft // 2 > context_frames * hop_size:
+            raise ValueError("context_frames should cover overlap_frames and half a window, but got "
+                             "context_frames={}, overlap_frames={}".format(context_frames, overlap_frames))
+        self.chunk_frames, self.context_frames = chunk_frames, context_frames
+        self.lookahead_frames, self.overlap_frames = lookahead_frames, overlap_frames
+        self.n_iters, self.momentum = n_iters, momentum
+        self.feature_type = feature_type
+        self.reset()
+
+    def reset(self):
+        """Start a new utterance"""
+        self._frames = None  # [D, T] of frames from self._offset on
+        self._offset = 0  # global index of self._frames[:, 0]
+        self._next = 0  # first frame not emitted yet
+        self._tail = None  # held back samples before sample self._next * hop_size
+        self._angles = None  # [F, T] phases of the last window
+        self._angles_offset = 0
+        self._zi = np.zeros(1)  # _inv_preemphasis state
+
+    def push(self, frames):
+        """
+        Args:
+            frames: [T, D], normalized spectrogram frames, numpy or torch
+        Returns:
+            pcm: [L], numpy float32, may be empty
+        """
+        frames = torch.as_tensor(frames, dtype=torch.float32).t()
+        self._frames = frames if self._frames is None else torch.cat((self._frames, frames.to(self._frames.device)), dim=1)
+        chunks = []
+        while self._total() - self._next >= self.chunk_frames + self.lookahead_frames:
+            chunks += [self._emit(self._next + self.chunk_frames, final=False)]
+        return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.float32)
+
+    def flush(self):
+        """Emit the remaining frames, then reset for a new utterance.
+        Returns:
+            pcm: [L], numpy float32
+        """
+        pcm = np.zeros(0, dtype=np.float32)
+        if self._total() > self._next:
+            pcm = self._emit(self._total(), final=True)
+        elif self._tail is not None:
+            # The waveform ends at the center of the last frame, hop_size before the tail
+            pcm, _ = signal.lfilter([1], [1, -hparams.preemphasis], self._tail[:-get_hop_size()], zi=self._zi)
+            pcm = pcm.astype(np.float32)
+        self.reset()
+        return pcm
+
+    def _total(self):
+        return self._offset + (self._frames.size(1) if self._frames is not None else 0)
+
+    def _emit(self, end, final):
+        """Reconstruct frames [self._next, end) and return their new samples"""
+        hop_size = get_hop_size()
+        start = max(self._offset, self._next - self.context_frames)
+        stop = self._total() if final else min(self._total(), end + self.lookahead_frames)
+        spec = self._frames[:, start - self._offset:stop - self._offset].unsqueeze(0)  # [1, D, Tw]
+        S = _to_magnitude(spec, self.feature_type)
+        lengths = torch.full((1,), stop - start, dtype=torch.long, device=S.device)
+        angles = torch.exp(2j * math.pi * torch.rand(S.shape, device=S.device))
+        if self._angles is not None:  # continue from the phases of the previous window
+            known = min(stop, self._angles_offset + self._angles.size(-1)) - start
+            angles[0, :, :known] = self._angles[:, start - self._angles_offset:start - self._angles_offset + known]
+        y, wav_lengths = _griffin_lim(S, lengths, self.n_iters, self.momentum, angles)
+        rebuilt, _ = _stft(y, wav_lengths)
+        self._angles, self._angles_offset = rebuilt[0] / (rebuilt[0].abs() + 1e-16), start
+        y = y[0].cpu().numpy()
+
+        # Samples [first, last) are new, relative to the window start
+        first = self._next * hop_size - start * hop_size
+        last = len(y) if final else (end - self.overlap_frames) * hop_size - start * hop_size
+        if self._tail is not None:  # cross-fade with the end of the previous chunk
+            first -= len(self._tail)
+            fade = np.sin(0.5 * np.pi * (np.arange(len(self._tail)) + 0.5) / len(self._tail)) ** 2
+            y[first:first + len(self._tail)] = (1 - fade) * self._tail + fade * y[first:first + len(self._tail)]
+        pcm = y[first:last]
+        self._tail = None if final else y[last:(end - start) * hop_size].copy()
+        self._next = end
+        # Keep only the frames the next window may need
+        drop = max(0, self._next - self.context_frames) - self._offset
+        if drop > 0:
+            self._frames, self._offset = self._frames[:, drop:], self._offset + drop
+
+        pcm, self._zi = signal.lfilter([1], [1, -hparams.preemphasis], pcm, zi=self._zi)
+        return pcm.astype(np.float32)
+
+
+if __name__ == '__main__':
+    # Batched features against audio_process of each utterance, run from the repo root:
+    # python -m utils.torch_audio
+    from utils import audio_process
+
+    rng = np.random.RandomState(0)
+    wavs = [0.5 * np.sin(2 * np.pi * rng.uniform(100, 400) * np.arange(length) / hparams.sample_rate)
+            + 0.01 * rng.randn(length) for length in (3 * hparams.sample_rate, 2 * hparams.sample_rate + 123)]
+    lengths = torch.LongTensor([len(wav) for wav in wavs])
+    wav_padded = torch.zeros(len(wavs), int(lengths.max()), dtype=torch.float64)
+    for i, wav in enumerate(wavs):
+        wav_padded[i, :len(wav)] = torch.from_numpy(wav)
+    # features are normalized to [-4, 4]; edge frames see the reflect padding of each utterance
+    for name, tolerance in (('spectrogram', 1e-3), ('melspectrogram', 1e-3)):
+        batch, frame_lengths = globals()[name](wav_padded, lengths)
+        for i, wav in enumerate(wavs):
+            expected = getattr(audio_process, name)(wav)
+            actual = batch[i, :, :frame_lengths[i]].numpy()
+            assert actual.shape == expected.shape, (name, actual.shape, expected.shape)
+            error = np.max(np.abs(actual - expected))
+            edge_error = np.max(np.abs(actual[:, [0, 1, -2, -1]] - expected[:, [0, 1, -2, -1]]))
+            print('{} {}: max error {:.2e}, edge frames {:.2e}'.format(name, i, error, edge_error))
+            assert error < tolerance and edge_error < tolerance, (name, i, error, edge_error)